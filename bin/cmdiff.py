@@ -1,52 +1,782 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
+import difflib
+import glob
+import mmap
+import os
+import re
+import shlex
+import struct
 import sys
 import errno
 import subprocess
 import time
-import tempfile
+import zlib
+
+from inotify import Inotify
 
 # cmdiff.py is a utility to repeatedly run the given command looking for
-# new output. If the command produces different output then diff will
-# be run to show the difference between the new and prior output.
+# new output. If the command produces different output then a unified
+# diff between the new and prior output is printed.
+#
+# When the command names existing paths (or globs), or paths are given
+# with --watch, the command is only re-run when inotify reports a change
+# to one of them. Otherwise it is re-run every --interval seconds.
 #
 # Example use:
 #   cmdiff.py ls -l '/dev/cu*'
 #   cmdiff.py lsusb
+#   cmdiff.py --watch /dev/bus/usb lsusb
+#   cmdiff.py --file ~/.cmdiff_dashboard
+#   cmdiff.py --history /tmp/usb.hist lsusb
+#   cmdiff.py --history /tmp/usb.hist --list
+#   cmdiff.py --history /tmp/usb.hist --replay 3 7
 
 
-def print_diff(base: bytes, other: bytes) -> None:
-    with tempfile.NamedTemporaryFile() as base_file:
-        base_file.write(base)
-        base_file.flush()
-        with tempfile.NamedTemporaryFile() as other_file:
-            other_file.write(other)
-            other_file.flush()
-            cmd = ['diff', '--color=always', base_file.name, other_file.name]
-            subprocess.run(cmd)
+class colors:
+    HUNK = b'\033[36m'
+    REMOVED = b'\033[31m'
+    ADDED = b'\033[32m'
+    END = b'\033[0m'
 
 
-def main(args: list):
-    if (len(args) < 1):
-        print("usage: cmdiff <command> [args]")
-        sys.exit(errno.EINVAL)
+def split_lines(data: memoryview) -> list:
+    r"""Split |data| into lines (without their newlines) as memoryview
+    slices, so no line is copied.
+
+    memoryviews of bytes are hashable and compare by content, and each
+    line's hash is computed once and cached.
+
+    >>> [bytes(line) for line in split_lines(b'a\nbb\n\nc')]
+    [b'a', b'bb', b'', b'c']
+    """
+    view = memoryview(data)
+    lines = []
+    start = 0
+    for m in re.finditer(b'\n', view):
+        lines.append(view[start:m.start()])
+        start = m.end()
+    if start < len(view):
+        lines.append(view[start:])
+    return lines
+
+
+def common_prefix_len(a: memoryview, b: memoryview,
+                      block: int = 65536) -> int:
+    """Return the length of the common prefix of two buffers.
+
+    Whole blocks are compared with memcmp and only a block which differs
+    is bisected, so this is O(n) and runs at memory speed.
+
+    >>> common_prefix_len(memoryview(b'abcdef'), memoryview(b'abcxef'), 2)
+    3
+    """
+    n = min(len(a), len(b))
+    pos = 0
+    while pos < n:
+        end = min(pos + block, n)
+        if a[pos:end] != b[pos:end]:
+            # A mismatch lies in [pos, end).
+            while end - pos > 1:
+                mid = (pos + end) // 2
+                if a[pos:mid] == b[pos:mid]:
+                    pos = mid
+                else:
+                    end = mid
+            return pos
+        pos = end
+    return n
+
+
+def common_suffix_len(a: memoryview, b: memoryview, limit: int,
+                      block: int = 65536) -> int:
+    """Return the length (at most |limit|) of the common suffix of two
+    buffers.
+
+    >>> common_suffix_len(memoryview(b'abcdef'), memoryview(b'abxdef'), 6, 2)
+    3
+    """
+    (len_a, len_b) = (len(a), len(b))
+    n = 0
+    while n < limit:
+        end = min(n + block, limit)
+        if a[len_a - end:len_a - n] != b[len_b - end:len_b - n]:
+            while end - n > 1:
+                mid = (n + end) // 2
+                if a[len_a - mid:len_a - n] == b[len_b - mid:len_b - n]:
+                    n = mid
+                else:
+                    end = mid
+            return n
+        n = end
+    return limit
+
+
+def unified_diff(base: bytes, other: bytes, context: int = 3) -> bytes:
+    r"""Return a colorized unified diff of two command outputs.
+
+    The common prefix and suffix are found with block compares first, so
+    only the lines which changed (plus |context| lines around them) are
+    split, hashed and given to the full diff.
+
+    >>> unified_diff(b'a\nb\nc\n', b'a\nB\nc\n', context=1)
+    b'\x1b[36m@@ -1,3 +1,3 @@\x1b[0m\n a\n\x1b[31m-b\x1b[0m\n\x1b[32m+B\x1b[0m\n c\n'
+    >>> unified_diff(b'a\n', b'a\n')
+    b''
+    """
+    if base == other:
+        return b''
+    view_a = memoryview(base)
+    view_b = memoryview(other)
+    prefix = common_prefix_len(view_a, view_b)
+    suffix = common_suffix_len(view_a, view_b,
+                               min(len(base), len(other)) - prefix)
+    # Widen to whole lines plus the context lines before and after.
+    start = base.rfind(b'\n', 0, prefix) + 1
+    for _ in range(context):
+        if start == 0:
+            break
+        start = base.rfind(b'\n', 0, start - 1) + 1
+    end = base.find(b'\n', len(base) - suffix)
+    end = len(base) if end == -1 else end + 1
+    for _ in range(context):
+        if end >= len(base):
+            break
+        end = base.find(b'\n', end)
+        end = len(base) if end == -1 else end + 1
+    end_b = end + len(other) - len(base)
+    skip = base.count(b'\n', 0, start)
+
+    a = split_lines(view_a[start:end])
+    b = split_lines(view_b[start:end_b])
+    out = []
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for group in matcher.get_grouped_opcodes(context):
+        (a_lo, b_lo) = (group[0][1], group[0][3])
+        (a_hi, b_hi) = (group[-1][2], group[-1][4])
+        # Like diff, an empty range starts at the line before it.
+        out.append(b'%s@@ -%d,%d +%d,%d @@%s\n' %
+                   (colors.HUNK, skip + a_lo + (a_hi > a_lo), a_hi - a_lo,
+                    skip + b_lo + (b_hi > b_lo), b_hi - b_lo, colors.END))
+        for (tag, i1, i2, j1, j2) in group:
+            if tag == 'equal':
+                out.extend(b' %s\n' % line for line in a[i1:i2])
+                continue
+            out.extend(b'%s-%s%s\n' % (colors.REMOVED, line, colors.END)
+                       for line in a[i1:i2])
+            out.extend(b'%s+%s%s\n' % (colors.ADDED, line, colors.END)
+                       for line in b[j1:j2])
+    return b''.join(out)
+
+
+def print_diff(base: bytes, other: bytes) -> None:
+    sys.stdout.buffer.write(unified_diff(base, other))
+    sys.stdout.buffer.flush()
 
-    cmd = ["bash", "-c", " ".join(args)]
+
+def run_command(cmd: list) -> bytes:
     result = subprocess.run(cmd,
                             capture_output=True,
                             shell=False,
                             check=False)
-    previous_output = result.stdout
-    while (True):
-        time.sleep(1.0)
-        r = subprocess.run(cmd,
-                           capture_output=True,
-                           shell=False,
-                           check=False)
-        current_output = r.stdout
-        if previous_output != current_output:
-            print_diff(previous_output, current_output)
-            previous_output = current_output
+    return result.stdout
+
+
+def command_paths(args: list) -> list:
+    """Return the directories to watch for the paths named in |args|.
+
+    Existing directories are watched directly. For files and globs the
+    containing directory is watched, so that files being created, deleted
+    or replaced are noticed too.
+
+    >>> command_paths(['ls', '-l', '/dev/cu*'])
+    ['/dev']
+    >>> command_paths(['lsusb'])
+    []
+    """
+    try:
+        tokens = shlex.split(' '.join(args))
+    except ValueError:
+        return []
+    paths = []
+    for token in tokens:
+        if token.startswith('-'):
+            continue
+        if glob.has_magic(token):
+            # The directory part before the first wildcard.
+            wildcard = min(token.find(c) for c in '*?[' if c in token)
+            token = os.path.dirname(token[:wildcard]) or '.'
+        elif not os.path.exists(token):
+            continue
+        if not os.path.isdir(token):
+            token = os.path.dirname(token) or '.'
+        token = os.path.abspath(token)
+        if os.path.isdir(token) and token not in paths:
+            paths.append(token)
+    return paths
+
+
+# File systems whose contents change without inotify ever reporting it.
+pseudo_fs_types = frozenset([
+    'proc', 'sysfs', 'debugfs', 'tracefs', 'securityfs', 'cgroup',
+    'cgroup2', 'configfs', 'pstore', 'bpf', 'efivarfs'
+])
+
+
+def fs_type(path: str) -> str:
+    """Return the type of the file system containing |path| (from
+    /proc/mounts), or None if it cannot be determined."""
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best = ('', None)
+    for (mount_point, fstype) in mounts:
+        mount_point = mount_point.replace('\\040', ' ')
+        if (path == mount_point or path.startswith(
+                mount_point.rstrip('/') + '/')) and \
+                len(mount_point) >= len(best[0]):
+            best = (mount_point, fstype)
+    return best[1]
+
+
+def inotify_can_watch(path: str) -> bool:
+    """Return False for paths on pseudo file systems such as /proc and /sys,
+    which never deliver inotify events.
+
+    >>> inotify_can_watch('/proc/uptime')
+    False
+    """
+    if path == '/proc' or path.startswith(('/proc/', '/sys/')):
+        return False
+    return fs_type(path) not in pseudo_fs_types
+
+
+class Waiter(object):
+    """Wait until it is time to re-run the command.
+
+    With watch paths (and inotify) this blocks until a change is reported,
+    then waits until no further change has arrived for |debounce| seconds
+    so that a burst of events causes a single run. Events that keep coming
+    delay the run by at most |max_debounce| seconds. The timeout passed to
+    wait() is the poll period when there is nothing to watch, and otherwise
+    an upper bound on how long to wait for an event.
+    """
+
+    watch_mask = (Inotify.IN_MODIFY | Inotify.IN_ATTRIB |
+                  Inotify.IN_CLOSE_WRITE | Inotify.IN_CREATE |
+                  Inotify.IN_DELETE | Inotify.IN_MOVED_FROM |
+                  Inotify.IN_MOVED_TO)
+
+    def __init__(self, paths: list, debounce: float,
+                 max_debounce: float = None):
+        self.debounce = debounce
+        self.max_debounce = max_debounce or 10 * debounce
+        self.inotify = None
+        if paths and Inotify.Supported():
+            self.inotify = Inotify()
+            for path in paths:
+                self.inotify.add_watch(path, Waiter.watch_mask)
+
+    def wait(self, timeout: float) -> None:
+        if not self.inotify:
+            time.sleep(timeout)
+            return
+        if not self.inotify.read_events(timeout):
+            return
+        deadline = time.monotonic() + self.max_debounce
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or \
+                    not self.inotify.read_events(min(self.debounce, remaining)):
+                return
+
+
+class Schedule(object):
+    """Adaptive interval between runs.
+
+    Each run whose output did not change multiplies the interval by
+    |backoff|, up to |max_interval|. A change resets it to |min_interval|
+    so the next few runs follow closely. Delays are measured from the start
+    of the previous run, so the command's own run time is not added to the
+    interval and runs neither overlap nor drift.
+
+    >>> s = Schedule(1.0, 4.0, 2.0)
+    >>> [s.update(changed) for changed in (False, False, False, True)]
+    [2.0, 4.0, 4.0, 1.0]
+    """
+
+    def __init__(self, min_interval: float, max_interval: float,
+                 backoff: float):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def update(self, changed: bool) -> float:
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval,
+                                self.interval * self.backoff)
+        return self.interval
+
+    def delay(self, last_start: float) -> float:
+        """Seconds to wait before the run after one started at
+        |last_start| (a time.monotonic() value)."""
+        return max(0.0, last_start + self.interval - time.monotonic())
+
+
+class Stats(object):
+    """Counters for tuning the schedule."""
+
+    def __init__(self):
+        self.runs = 0
+        self.changes = 0
+        self.run_time = 0.0
+        self.bytes_compared = 0
+
+    def __str__(self):
+        mean_ms = 1000.0 * self.run_time / self.runs if self.runs else 0.0
+        return ('runs: %d, changes: %d, mean command latency: %.1f ms, '
+                'compared: %.1f KB' % (self.runs, self.changes, mean_ms,
+                                       self.bytes_compared / 1024.0))
+
+
+class History(object):
+    """A bounded ring buffer of output snapshots.
+
+    Each snapshot is stored as a record holding the zlib compressed bytes
+    which differ from the previous snapshot (after trimming the common
+    prefix and suffix). Every |keyframe_interval| records, or when a delta
+    would not save space, a full snapshot (keyframe) is stored instead.
+    When the buffer is full the oldest keyframe and its deltas are evicted
+    together, so the oldest remaining record is always a keyframe.
+
+    With a |path| the buffer is a memory-mapped file which survives
+    restarts, otherwise it lives in memory.
+
+    >>> h = History(4096)
+    >>> [h.add(b'a\\nb\\n'), h.add(b'a\\nc\\n'), h.add(b'a\\nc\\nd\\n')]
+    [0, 1, 2]
+    >>> h.snapshot(1)
+    b'a\\nc\\n'
+    >>> [e[0] for e in h.entries]
+    [0, 1, 2]
+    """
+    magic = b'CMDHIST1'
+    # magic, capacity, head, tail, count, next_seq
+    header = struct.Struct('<8sQQQQQ')
+    # kind, payload size, seq, time, prefix, suffix, snapshot size
+    record = struct.Struct('<BIQdQQQ')
+    WRAP, KEY, DELTA = 0, 1, 2
+    keyframe_interval = 32
+
+    def __init__(self, capacity: int = 16 << 20, path: str = None,
+                 readonly: bool = False):
+        """Only a new or empty |path| is initialized. Raises ValueError if
+        |path| holds anything else, and OSError if it cannot be opened.
+        A |readonly| history must already exist."""
+        if path:
+            flags = os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT
+            fd = os.open(path, flags, 0o644)
+            try:
+                file_size = os.fstat(fd).st_size
+                fields = None
+                if file_size:
+                    fields = self.header.unpack(
+                        os.pread(fd, self.header.size, 0).ljust(
+                            self.header.size, b'\0'))
+                    if fields[0] != self.magic or \
+                            file_size < self.header.size + fields[1]:
+                        raise ValueError('%s is not a cmdiff history file' %
+                                         path)
+                    capacity = fields[1]
+                elif readonly:
+                    raise ValueError('%s is empty' % path)
+                else:
+                    os.ftruncate(fd, self.header.size + capacity)
+                self.buf = mmap.mmap(
+                    fd, self.header.size + capacity,
+                    access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+            finally:
+                os.close(fd)
+        else:
+            fields = None
+            self.buf = bytearray(self.header.size + capacity)
+        self.capacity = capacity
+        # (seq, time, kind, offset, snapshot size), oldest first.
+        self.entries = []
+        self.latest = None
+        if fields:
+            self._load(fields)
+        else:
+            (self.head, self.tail, self.next_seq) = (0, 0, 0)
+            self._write_header()
+
+    def _write_header(self):
+        self.header.pack_into(self.buf, 0, self.magic, self.capacity,
+                              self.head, self.tail, len(self.entries),
+                              self.next_seq)
+
+    def _read_record(self, pos: int) -> tuple:
+        """Return (pos, fields) of the record at |pos|, following a wrap."""
+        if pos + self.record.size > self.capacity or \
+                self.buf[self.header.size + pos] == self.WRAP:
+            pos = 0
+        return (pos, self.record.unpack_from(self.buf,
+                                             self.header.size + pos))
+
+    def _load(self, fields: tuple):
+        (_, _, self.head, self.tail, count, self.next_seq) = fields
+        pos = self.head
+        for _ in range(count):
+            (pos, (kind, size, seq, when, _, _, length)) = \
+                self._read_record(pos)
+            self.entries.append((seq, when, kind, pos, length))
+            pos += self.record.size + size
+
+    def _payload(self, index: int) -> tuple:
+        """Return (kind, prefix, suffix, data) of entries[|index|]."""
+        pos = self.header.size + self.entries[index][3]
+        (kind, size, _, _, prefix, suffix, _) = \
+            self.record.unpack_from(self.buf, pos)
+        start = pos + self.record.size
+        return (kind, prefix, suffix,
+                zlib.decompress(self.buf[start:start + size]))
+
+    def _find_space(self, size: int):
+        """Return the offset to write |size| bytes at, or None if full."""
+        if not self.entries:
+            (self.head, self.tail) = (0, 0)
+            return 0
+        if self.tail > self.head:
+            if self.tail + size <= self.capacity:
+                return self.tail
+            if size <= self.head:
+                if self.tail + self.record.size <= self.capacity:
+                    self.buf[self.header.size + self.tail] = self.WRAP
+                return 0
+            return None
+        # Wrapped (or full when tail == head).
+        return self.tail if self.tail + size <= self.head else None
+
+    def _evict(self):
+        """Drop the oldest keyframe and the deltas which depend on it."""
+        del self.entries[0]
+        while self.entries and self.entries[0][2] == self.DELTA:
+            del self.entries[0]
+        if self.entries:
+            self.head = self.entries[0][3]
+
+    def add(self, output: bytes, when: float = None):
+        """Append |output| and return its sequence number, or None if it
+        is too big to ever fit."""
+        if self.latest is None and self.entries:
+            self.latest = self.snapshot(self.entries[-1][0])
+        kind = self.KEY
+        (prefix, suffix, data) = (0, 0, output)
+        since_key = 0
+        for entry in reversed(self.entries):
+            if entry[2] == self.KEY:
+                break
+            since_key += 1
+        if self.entries and since_key + 1 < self.keyframe_interval:
+            (a, b) = (memoryview(self.latest), memoryview(output))
+            prefix = common_prefix_len(a, b)
+            suffix = common_suffix_len(a, b, min(len(a), len(b)) - prefix)
+            (kind, data) = (self.DELTA,
+                            output[prefix:len(output) - suffix])
+        payload = zlib.compress(data)
+        if kind == self.DELTA and len(payload) >= len(zlib.compress(output)):
+            (kind, prefix, suffix) = (self.KEY, 0, 0)
+            payload = zlib.compress(output)
+        size = self.record.size + len(payload)
+        if size > self.capacity:
+            return None
+        while True:
+            pos = self._find_space(size)
+            if pos is not None:
+                break
+            last_key = max(i for (i, e) in enumerate(self.entries)
+                           if e[2] == self.KEY)
+            if kind == self.DELTA and last_key == 0:
+                # Evicting would drop the keyframe this delta needs.
+                (kind, prefix, suffix) = (self.KEY, 0, 0)
+                payload = zlib.compress(output)
+                size = self.record.size + len(payload)
+                if size > self.capacity:
+                    return None
+            self._evict()
+        seq = self.next_seq
+        when = time.time() if when is None else when
+        self.record.pack_into(self.buf, self.header.size + pos, kind,
+                              len(payload), seq, when, prefix, suffix,
+                              len(output))
+        start = self.header.size + pos + self.record.size
+        self.buf[start:start + len(payload)] = payload
+        if not self.entries:
+            self.head = pos
+        self.entries.append((seq, when, kind, pos, len(output)))
+        self.tail = pos + size
+        self.next_seq += 1
+        self.latest = output
+        self._write_header()
+        return seq
+
+    def snapshot(self, seq: int) -> bytes:
+        """Return the output recorded as |seq|."""
+        index = next((i for (i, e) in enumerate(self.entries)
+                      if e[0] == seq), None)
+        if index is None:
+            raise KeyError('no snapshot %d in history' % seq)
+        key = index
+        while self.entries[key][2] != self.KEY:
+            key -= 1
+        output = b''
+        for i in range(key, index + 1):
+            (kind, prefix, suffix, data) = self._payload(i)
+            if kind == self.KEY:
+                output = data
+            else:
+                output = b''.join((output[:prefix], data,
+                                   output[len(output) - suffix:]))
+        return output
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+
+
+def read_commands(path: str, default_interval: float) -> list:
+    """Read a dashboard file of "[interval] command" lines.
+
+    Returns a list of (interval, command). Blank lines and lines starting
+    with # are ignored.
+    """
+    commands = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            (first, _, rest) = line.partition(' ')
+            try:
+                commands.append((float(first), rest.strip()))
+            except ValueError:
+                commands.append((default_interval, line))
+    return commands
+
+
+async def run_command_async(cmd: list, limit: asyncio.Semaphore) -> bytes:
+    async with limit:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        (stdout, _) = await proc.communicate()
+    return stdout
+
+
+async def watch_command(command: str, schedule: Schedule,
+                        limit: asyncio.Semaphore, stats: Stats) -> None:
+    """Run |command| on |schedule| forever, printing timestamped diffs."""
+    cmd = ["bash", "-c", command]
+    title = command.encode()
+    previous_output = None
+    while True:
+        start = time.monotonic()
+        current_output = await run_command_async(cmd, limit)
+        stats.runs += 1
+        stats.run_time += time.monotonic() - start
+        if previous_output is not None:
+            stats.bytes_compared += len(current_output)
+            changed = previous_output != current_output
+            schedule.update(changed)
+            if changed:
+                stats.changes += 1
+                now = time.strftime('%H:%M:%S').encode()
+                header = b'%s[%s] %s%s\n' % (colors.HUNK, now, title,
+                                              colors.END)
+                sys.stdout.buffer.write(
+                    header + unified_diff(previous_output, current_output))
+                sys.stdout.buffer.flush()
+        previous_output = current_output
+        await asyncio.sleep(schedule.delay(start))
+
+
+async def dashboard(commands: list, max_interval: float, backoff: float,
+                    jobs: int, all_stats: dict) -> None:
+    """Watch every (interval, command) in one event loop, running at most
+    |jobs| commands at once."""
+    limit = asyncio.Semaphore(jobs)
+    watchers = []
+    for (interval, command) in commands:
+        schedule = Schedule(interval, max_interval or 8 * interval, backoff)
+        all_stats[command] = Stats()
+        watchers.append(watch_command(command, schedule, limit,
+                                      all_stats[command]))
+    await asyncio.gather(*watchers)
+
+
+def parse_args(args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='cmdiff',
+        description='Repeatedly run a command and show changes in its output.')
+    parser.add_argument('-w', '--watch', action='append', default=[],
+                        help='Re-run when this path changes (repeatable). '
+                        'Default: paths named in the command')
+    parser.add_argument('-n', '--no-watch', action='store_true',
+                        help='Ignore paths and re-run every --interval')
+    parser.add_argument('-i', '--interval', type=float, default=None,
+                        help='Seconds between runs when polling, or between '
+                        'runs without an event when watching (default: 1, '
+                        'or 60 when watching)')
+    parser.add_argument('-m', '--max-interval', type=float, default=None,
+                        help='When polling, back off up to this many seconds '
+                        'while the output is unchanged (default: 8x '
+                        '--interval; set to --interval to disable)')
+    parser.add_argument('-b', '--backoff', type=float, default=1.5,
+                        help='Interval multiplier per unchanged run')
+    parser.add_argument('-d', '--debounce', type=float, default=0.1,
+                        help='Seconds without events before re-running '
+                        '(but re-run at least every 10x --debounce while '
+                        'events keep arriving)')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='Print run statistics after each change and on '
+                        'exit')
+    parser.add_argument('-f', '--file',
+                        help='Dashboard: watch every "[interval] command" '
+                        'line of this file in one process')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Dashboard: maximum commands running at once')
+    parser.add_argument('--history',
+                        help='Record every distinct output in this '
+                        'memory-mapped ring buffer file')
+    parser.add_argument('--history-size', type=int, default=16 << 20,
+                        help='Size in bytes of a new --history file '
+                        '(oldest snapshots are evicted when full)')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='List the snapshots in --history and exit')
+    parser.add_argument('-r', '--replay', type=int, nargs='+',
+                        metavar='SEQ',
+                        help='Print the diff between two snapshots in '
+                        '--history (or between SEQ and the one before it) '
+                        'and exit')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    return parser.parse_args(args)
+
+
+def show_history(history: History, replay: list) -> None:
+    """List the snapshots in |history|, or print the diff between the two
+    snapshots in |replay|."""
+    if not replay:
+        for (seq, when, kind, _, length) in history.entries:
+            print('%6d  %s  %8d bytes%s' % (
+                seq, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)),
+                length, '' if kind == History.DELTA else '  (keyframe)'))
+        return
+    (a, b) = (replay[0] - 1, replay[0]) if len(replay) == 1 else replay[:2]
+    try:
+        print_diff(history.snapshot(a), history.snapshot(b))
+    except KeyError as e:
+        print('cmdiff: %s' % e.args[0], file=sys.stderr)
+        sys.exit(errno.ENOENT)
+
+
+def main(args: list):
+    opts = parse_args(args)
+    if opts.list or opts.replay:
+        if not opts.history:
+            print('cmdiff: --list and --replay need a --history file',
+                  file=sys.stderr)
+            sys.exit(errno.EINVAL)
+        try:
+            history = History(path=opts.history, readonly=True)
+        except (OSError, ValueError) as e:
+            print('cmdiff: %s' % e, file=sys.stderr)
+            sys.exit(errno.EINVAL)
+        show_history(history, opts.replay)
+        return
+    if opts.file:
+        commands = read_commands(opts.file, opts.interval or 1.0)
+        all_stats = {}
+        try:
+            asyncio.run(dashboard(commands, opts.max_interval, opts.backoff,
+                                  opts.jobs, all_stats))
+        except KeyboardInterrupt:
+            if opts.stats:
+                for (command, stats) in all_stats.items():
+                    print('%s: %s' % (command, stats), file=sys.stderr)
+        return
+    if (len(opts.command) < 1):
+        print("usage: cmdiff [options] <command> [args]")
+        sys.exit(errno.EINVAL)
+
+    paths = []
+    if not opts.no_watch:
+        paths = [os.path.abspath(p) for p in opts.watch] or \
+            command_paths(opts.command)
+        if not all(inotify_can_watch(p) for p in paths):
+            # Changes to the others would never be seen, so poll instead.
+            paths = []
+    try:
+        waiter = Waiter(paths, opts.debounce)
+    except OSError as e:
+        print('cmdiff: %s' % e, file=sys.stderr)
+        sys.exit(errno.EINVAL)
+    interval = opts.interval
+    if waiter.inotify:
+        # Events trigger the runs, so the fallback interval stays fixed.
+        interval = interval or 60.0
+        max_interval = interval
+    else:
+        interval = interval or 1.0
+        max_interval = opts.max_interval or 8 * interval
+    schedule = Schedule(interval, max_interval, opts.backoff)
+    stats = Stats()
+    cmd = ["bash", "-c", " ".join(opts.command)]
+
+    def timed_run() -> tuple:
+        start = time.monotonic()
+        output = run_command(cmd)
+        stats.runs += 1
+        stats.run_time += time.monotonic() - start
+        return (start, output)
+
+    (last_start, previous_output) = timed_run()
+    history = None
+    if opts.history:
+        try:
+            history = History(opts.history_size, opts.history)
+        except (OSError, ValueError) as e:
+            print('cmdiff: %s' % e, file=sys.stderr)
+            sys.exit(errno.EINVAL)
+        if not history.entries or \
+                history.snapshot(history.entries[-1][0]) != previous_output:
+            history.add(previous_output)
+    try:
+        while (True):
+            waiter.wait(schedule.delay(last_start))
+            (last_start, current_output) = timed_run()
+            stats.bytes_compared += len(current_output)
+            changed = previous_output != current_output
+            schedule.update(changed)
+            if changed:
+                stats.changes += 1
+                print_diff(previous_output, current_output)
+                previous_output = current_output
+                if history is not None:
+                    history.add(current_output)
+                if opts.stats:
+                    print('%s, interval: %.2fs' % (stats, schedule.interval),
+                          file=sys.stderr)
+    except KeyboardInterrupt:
+        if opts.stats:
+            print('%s, interval: %.2fs' % (stats, schedule.interval),
+                  file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -4,13 +4,47 @@
 # each log output line from a Chromium log. This is helpful
 # when wanting to "diff" two logs.
 
-import fileinput
+import argparse
+import array
+import collections
+import contextlib
+import fnmatch
+import heapq
+import itertools
+import json
+import lzma
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os
 import platform
+import queue
 import re
+import shutil
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from inotify import Inotify
 
 reg = re.compile(r'^\[\d+:\d+:\d+/\d+.\d+:([^:]+):([^\]]+)\] (.*)')
+# |reg| for undecoded (bytes) lines.
+breg = re.compile(reg.pattern.encode())
+# Every field in the prefix of an undecoded log line.
+field_reg = re.compile(
+    rb'^\[(\d+):(\d+):(\d+)/(\d+).(\d+):([^:\n]+):([^\]\n]+)\] ')
+source_line_reg = re.compile(rb'^(.*)\((\d+)\)$')
+# Just the date and time fields of an undecoded log line.
+time_reg = re.compile(rb'\[\d+:\d+:(\d+)/(\d+).(\d+):')
+
+LogRecord = collections.namedtuple('LogRecord', [
+    'pid', 'tid', 'month_day', 'time_us', 'level', 'source_file',
+    'line_number', 'message'
+])
 
 class BadLogLine(Exception):
     pass
@@ -26,6 +60,149 @@ class bcolors:
     ENDC = '\033[0m'
 
 
+class Highlighter(object):
+    r"""Find which of many highlight patterns a message matches.
+
+    All patterns are combined into a single regex, so each message is
+    scanned once however many patterns there are. Literal terms are merged
+    into a trie shaped regex (e.g. "abc|abd" becomes "ab(?:c|d)"), which
+    keeps the cost of matching them close to flat as terms are added.
+    Regular expressions are tried after the terms. When several patterns
+    match, the color of the leftmost match wins. Combining them renumbers
+    their groups, so numbered backreferences (\1) are rejected; use named
+    groups and (?P=name) instead.
+
+    >>> h = Highlighter([('XXX', bcolors.OKBLUE), ('XY', bcolors.FAIL)],
+    ...                 [(r'0x[0-9a-f]+', bcolors.HEADER)])
+    >>> h.color('a XYZ b') == bcolors.FAIL
+    True
+    >>> h.color(b'at 0x7ffe') == bcolors.HEADER.encode()
+    True
+    >>> h.color('nothing') is None
+    True
+    >>> Highlighter([], [(r'(a)\1', bcolors.FAIL)])
+    Traceback (most recent call last):
+     ...
+    ValueError: numbered backreference in highlight pattern: (a)\1
+    """
+
+    colors = {
+        'blue': bcolors.OKBLUE,
+        'green': bcolors.OKGREEN,
+        'yellow': bcolors.WARNING,
+        'red': bcolors.FAIL,
+        'magenta': bcolors.HEADER,
+    }
+
+    # A backslash (not itself escaped) followed by a group number.
+    backreference_regex = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]')
+
+    def __init__(self, terms=(), patterns=()):
+        """|terms| and |patterns| are lists of (text, color) tuples. Terms
+        are matched literally, patterns as regular expressions."""
+        self.term_colors = dict((t, c) for (t, c) in terms)
+        self.pattern_colors = [c for (_, c) in patterns]
+        alternatives = []
+        if terms:
+            alternatives.append('(?P<term>%s)' %
+                                Highlighter._TrieRegex(self.term_colors))
+        for (i, (pattern, _)) in enumerate(patterns):
+            if Highlighter.backreference_regex.search(pattern):
+                raise ValueError(
+                    'numbered backreference in highlight pattern: %s' %
+                    pattern)
+            alternatives.append('(?P<p%d>%s)' % (i, pattern))
+        self.regex = re.compile('|'.join(alternatives))
+        self.bregex = re.compile('|'.join(alternatives).encode())
+        self.bterm_colors = dict((t.encode(), c.encode())
+                                 for (t, c) in self.term_colors.items())
+        self.bpattern_colors = [c.encode() for c in self.pattern_colors]
+
+    @staticmethod
+    def _TrieRegex(terms):
+        """Return a regex matching any of |terms| with shared prefixes
+        merged.
+
+        >>> Highlighter._TrieRegex(['abc', 'abd', 'a'])
+        'a(?:b(?:c|d))?'
+        """
+        trie = {}
+        for term in terms:
+            node = trie
+            for ch in term:
+                node = node.setdefault(ch, {})
+            node[''] = {}
+
+        def build(node):
+            alternatives = [re.escape(ch) + build(child)
+                            for (ch, child) in sorted(node.items()) if ch]
+            if not alternatives:
+                return ''
+            if len(alternatives) == 1 and '' not in node:
+                return alternatives[0]
+            regex = '(?:%s)' % '|'.join(alternatives)
+            # Greedy, so the longest term wins.
+            return regex + '?' if '' in node else regex
+
+        return build(trie)
+
+    @staticmethod
+    def Create(highlight):
+        """Return a Highlighter for |highlight| which may already be one, a
+        single string to highlight in blue, or None."""
+        if not highlight or isinstance(highlight, Highlighter):
+            return highlight or None
+        return Highlighter([(highlight, bcolors.OKBLUE)])
+
+    @staticmethod
+    def FromFile(path, terms=()):
+        """Load highlight patterns from a file. Each line is either
+
+            pattern
+            color, pattern
+
+        where color is one of Highlighter.colors (default blue). A pattern
+        wrapped in slashes (/0x[0-9a-f]+/) is a regular expression, anything
+        else is matched literally. Blank lines and lines starting with # are
+        ignored. |terms| are extra literal terms to highlight in blue."""
+        terms = [(t, bcolors.OKBLUE) for t in terms]
+        patterns = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                color = bcolors.OKBLUE
+                (name, comma, rest) = line.partition(',')
+                if comma and name.strip().lower() in Highlighter.colors:
+                    color = Highlighter.colors[name.strip().lower()]
+                    line = rest.strip()
+                if len(line) > 1 and line.startswith('/') and \
+                        line.endswith('/'):
+                    patterns.append((line[1:-1], color))
+                else:
+                    terms.append((line, color))
+        return Highlighter(terms, patterns)
+
+    def color(self, message):
+        """The color for |message| (str or bytes, returned as the same type)
+        or None if it matches no pattern."""
+        if isinstance(message, bytes):
+            (regex, term_colors, pattern_colors) = (self.bregex,
+                                                    self.bterm_colors,
+                                                    self.bpattern_colors)
+        else:
+            (regex, term_colors, pattern_colors) = (self.regex,
+                                                    self.term_colors,
+                                                    self.pattern_colors)
+        m = regex.search(message)
+        if not m:
+            return None
+        if m.lastgroup == 'term':
+            return term_colors[m.group('term')]
+        return pattern_colors[int(m.lastgroup[1:])]
+
+
 def SplitLogLine(line):
     """Split a log line into three components: level, source, and log message.
 
@@ -51,6 +228,37 @@ def SplitLogLine(line):
         return (m.group(1), m.group(2), m.group(3))
     raise BadLogLine()
 
+def ParseLogLine(line):
+    r"""Parse every field out of an undecoded log line.
+
+    The time of day is converted to microseconds. line_number is 0 when the
+    source has none.
+
+    >>> ParseLogLine(b'[16960:775:0114/114420.990441:INFO:CONSOLE(24)] "The text"\n')
+    LogRecord(pid=16960, tid=775, month_day=114, time_us=42260990441, level=b'INFO', source_file=b'CONSOLE', line_number=24, message=b'"The text"')
+    >>> ParseLogLine(b'Not a line')  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+     ...
+    BadLogLine
+    """
+    prefix = field_reg.match(line)
+    if not prefix:
+        raise BadLogLine()
+    (pid, tid, month_day, hhmmss, fraction, level, source) = prefix.groups()
+    hhmmss = int(hhmmss)
+    seconds = (hhmmss // 10000) * 3600 + (hhmmss // 100 % 100) * 60 + \
+        hhmmss % 100
+    # Chromium logs microseconds, but be tolerant of other precisions.
+    micros = int(fraction[:6].ljust(6, b'0'))
+    m = source_line_reg.match(source)
+    if m:
+        (source, line_number) = (m.group(1), int(m.group(2)))
+    else:
+        line_number = 0
+    return LogRecord(int(pid), int(tid), int(month_day),
+                     seconds * 1000000 + micros, level, source, line_number,
+                     line[prefix.end():].rstrip(b'\r\n'))
+
 def CreateColorizedLogLine(line, highlight_text=None):
     try:
         (log_level, source, message) = SplitLogLine(line)
@@ -68,7 +276,9 @@ def CreateColorizedLogLine(line, highlight_text=None):
             log_level = 'I'
             start_color = bcolors.OKGREEN
             end_color = bcolors.ENDC
-        if highlight_text and highlight_text in message:
+        if isinstance(highlight_text, Highlighter):
+            start_color = highlight_text.color(message) or start_color
+        elif highlight_text and highlight_text in message:
             start_color = bcolors.OKBLUE
         return '%s%s> %s: %s%s' % (start_color, log_level, source, message,
                                    end_color)
@@ -79,8 +289,1527 @@ def PrintColorizedLogLines(lines, highlight_text=None):
     for line in lines:
         print(CreateColorizedLogLine(line, highlight_text))
 
-if __name__ == "__main__":
-    import doctest
-    doctest.testmod()
 
-    PrintColorizedLogLines(fileinput.input(), 'XXX')
+# Default size of each read when streaming a log file. Large enough that
+# the per-chunk Python overhead disappears, small enough to stay in cache.
+default_chunk_size = 4 * 1024 * 1024
+
+
+def ReadLineChunks(f, chunk_size=default_chunk_size):
+    r"""Read a binary file in large chunks, each ending on a line boundary.
+
+    Only the final chunk may lack a trailing newline. Lines are never
+    decoded.
+
+    >>> import io
+    >>> list(ReadLineChunks(io.BytesIO(b'one\ntwo\nthree'), 5))
+    [b'one\n', b'two\n', b'three']
+    >>> list(ReadLineChunks(io.BytesIO(b''), 5))
+    []
+    """
+    carry = b''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        idx = data.rfind(b'\n')
+        if idx == -1:
+            carry += data
+            continue
+        yield carry + data[:idx + 1]
+        carry = data[idx + 1:]
+    if carry:
+        yield carry
+
+
+class BadCompressedLog(Exception):
+    pass
+
+
+# (format, magic bytes at the start of the file).
+compression_magic = [
+    ('gzip', b'\x1f\x8b'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+    ('xz', b'\xfd7zXZ\x00'),
+]
+
+# Size of each compressed read when decompressing sequentially.
+compressed_read_size = 1024 * 1024
+# Largest block handed from a decompressing thread to the reader.
+decompressed_block_size = 1024 * 1024
+# Largest gzip member (compressed or not) inflated whole by a worker thread.
+# Bigger ones are inflated sequentially in blocks, so that the results in
+# flight stay bounded.
+parallel_member_size = 8 * 1024 * 1024
+
+
+def GetCompression(path):
+    """Return 'gzip', 'zstd', 'xz' or None based on the file's magic."""
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    for (fmt, magic) in compression_magic:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+class DecompressingReader(object):
+    """A read-only binary file whose data comes from an iterator of
+    decompressed blocks run in a background thread.
+
+    Decompression therefore overlaps with whatever the caller does with the
+    data. Blocks are split to at most |decompressed_block_size| bytes and
+    the queue between the two holds at most |queue_size| of them, so a slow
+    consumer does not cause unbounded memory growth. close() stops the
+    producer (and so any decompressing child process) early.
+    """
+
+    def __init__(self, blocks, queue_size=8):
+        self.queue = queue.Queue(queue_size)
+        self.pending = b''
+        self.eof = False
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._produce, args=(blocks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self, blocks):
+        try:
+            for block in blocks:
+                for pos in range(0, len(block), decompressed_block_size):
+                    if self.stopped:
+                        return
+                    self.queue.put(block[pos:pos + decompressed_block_size])
+        except Exception as e:
+            self.error = e
+        finally:
+            # Runs the generator's cleanup (e.g. killing zstd) in the thread
+            # which is running it.
+            blocks.close()
+            self.queue.put(None)
+
+    def read(self, size=-1):
+        """Read up to |size| bytes. May return fewer before EOF."""
+        if not self.pending and not self.eof:
+            block = self.queue.get()
+            if block is None:
+                self.eof = True
+                if self.error:
+                    raise self.error
+            else:
+                self.pending = block
+        if size < 0 or size >= len(self.pending):
+            (data, self.pending) = (self.pending, b'')
+        else:
+            (data, self.pending) = (self.pending[:size], self.pending[size:])
+        return data
+
+    def close(self):
+        self.stopped = True
+        # Drain the queue so that a blocked producer can see |stopped|.
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _InflateFrom(data, pos):
+    """Sequentially inflate the gzip member starting at |pos| in |data|.
+
+    Yields decompressed blocks and returns the offset just past the
+    member."""
+    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while not d.eof:
+        piece = d.unconsumed_tail
+        if not piece:
+            if pos >= len(data):
+                raise BadCompressedLog('truncated gzip member')
+            piece = data[pos:pos + compressed_read_size]
+            pos += len(piece)
+        # Bound the output: logs often inflate 10x or more.
+        yield d.decompress(piece, decompressed_block_size)
+    return pos - len(d.unused_data)
+
+
+def _InflateRange(data, start, end):
+    """Inflate data[start:end] if it is exactly one gzip member of at most
+    |parallel_member_size| bytes, otherwise return None."""
+    if end - start > parallel_member_size:
+        return None
+    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    try:
+        out = d.decompress(data[start:end], parallel_member_size)
+    except zlib.error:
+        return None
+    if d.eof and not d.unused_data:
+        return out
+    return None
+
+
+def _GzipMemberStarts(data):
+    """Offsets which might be the start of a gzip member: every gzip magic
+    followed by the deflate method and valid flags. All real member starts
+    are included. Some may be false positives from inside compressed data.
+    """
+    starts = []
+    pos = data.find(b'\x1f\x8b\x08')
+    while pos != -1:
+        if pos + 3 < len(data) and not data[pos + 3] & 0xe0:
+            starts.append(pos)
+        pos = data.find(b'\x1f\x8b\x08', pos + 1)
+    return starts
+
+
+def _WindowedMap(pool, func, items, window):
+    """Like pool.imap() but keeps at most |window| results in flight, so
+    that memory stays bounded when the consumer is slower than the pool."""
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _GzipBlocks(path, jobs):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    starts = _GzipMemberStarts(data) if jobs != 1 else [0]
+    if len(starts) < 2:
+        pos = 0
+        while pos < len(data) and data[pos:pos + 2] == b'\x1f\x8b':
+            pos = yield from _InflateFrom(data, pos)
+        return
+    # Inflate the candidate members in parallel. zlib releases the GIL so
+    # threads are enough. A candidate that turns out not to be exactly one
+    # member (a false positive, or a member containing one), or is too big
+    # to inflate whole, is redone sequentially from the last known member
+    # boundary.
+    ranges = list(zip(starts, starts[1:] + [len(data)]))
+    work = [(data, start, end) for (start, end) in ranges]
+    with multiprocessing.pool.ThreadPool(jobs) as pool:
+        window = 2 * (jobs or os.cpu_count() or 1)
+        pos = 0
+        for ((start, end), out) in zip(ranges,
+                                       _WindowedMap(pool, _InflateRange, work,
+                                                    window)):
+            if start < pos:
+                continue
+            if start == pos and out is not None:
+                yield out
+                pos = end
+                continue
+            while pos < end:
+                pos = yield from _InflateFrom(data, pos)
+
+
+def _ZstdSeekTable(data):
+    """Return the (offset, size) of every frame of a seekable zstd file
+    (see zstd's contrib/seekable_format), or None if it has no seek table."""
+    if len(data) < 9:
+        return None
+    (num_frames, descriptor, magic) = struct.unpack('<IBI', data[-9:])
+    if magic != 0x8F92EAB1:
+        return None
+    entry_size = 12 if descriptor & 0x80 else 8
+    table_size = num_frames * entry_size + 9
+    table_start = len(data) - table_size
+    (skippable_magic, frame_size) = struct.unpack(
+        '<II', data[table_start - 8:table_start])
+    if skippable_magic != 0x184D2A5E or frame_size != table_size:
+        return None
+    frames = []
+    offset = 0
+    for i in range(num_frames):
+        (size,) = struct.unpack_from('<I', data, table_start + i * entry_size)
+        frames.append((offset, size))
+        offset += size
+    return frames
+
+
+def _ZstdDecompressFrame(data, offset, size):
+    return subprocess.run(['zstd', '-dcq'], input=data[offset:offset + size],
+                          stdout=subprocess.PIPE, check=True).stdout
+
+
+def _ZstdBlocks(path, jobs):
+    # zstd is not in the standard library, so use the zstd tool. Each frame
+    # (or the whole file) is decompressed in its own process.
+    frames = None
+    if jobs != 1:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        frames = _ZstdSeekTable(data)
+    if frames and len(frames) > 1:
+        work = [(data, offset, size) for (offset, size) in frames]
+        with multiprocessing.pool.ThreadPool(jobs) as pool:
+            window = 2 * (jobs or os.cpu_count() or 1)
+            for out in _WindowedMap(pool, _ZstdDecompressFrame, work, window):
+                yield out
+        return
+    p = subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE)
+    try:
+        for block in iter(lambda: p.stdout.read(compressed_read_size), b''):
+            yield block
+    except GeneratorExit:
+        # Stopped early by DecompressingReader.close().
+        p.kill()
+        p.wait()
+        raise
+    finally:
+        p.stdout.close()
+    if p.wait():
+        raise BadCompressedLog('zstd failed on %s' % path)
+
+
+def _XzBlocks(path):
+    with lzma.open(path) as f:
+        for block in iter(lambda: f.read(compressed_read_size), b''):
+            yield block
+
+
+def OpenLogFile(path, jobs=1, queue_size=8):
+    """Open a log for binary reading, transparently decompressing gzip, zstd
+    and xz files in the background. Multi-member gzip and seekable zstd
+    files are decompressed with |jobs| threads (None = one per CPU). At
+    most |queue_size| decompressed blocks are buffered."""
+    fmt = GetCompression(path)
+    if fmt == 'gzip':
+        return DecompressingReader(_GzipBlocks(path, jobs), queue_size)
+    if fmt == 'zstd':
+        return DecompressingReader(_ZstdBlocks(path, jobs), queue_size)
+    if fmt == 'xz':
+        return DecompressingReader(_XzBlocks(path), queue_size)
+    return open(path, 'rb')
+
+
+class ChunkColorizer(object):
+    r"""Colorize whole chunks of log lines at once.
+
+    A single multi-line regex scans the chunk in C and a small callback
+    builds each colorized line directly from the undecoded bytes. The output
+    is byte-for-byte what CreateColorizedLogLine() produces. Lines which are
+    not log lines are passed through untouched.
+
+    >>> c = ChunkColorizer()
+    >>> c.colorize(b'[1:2:0114/114420.990441:ERROR:a.cc(1)] boom\nnot a line\n')
+    b'\x1b[91mE> a.cc(1): boom\x1b[0m\nnot a line\n'
+    >>> line = '[1:2:0114/114420.990441:INFO:a.cc(1)] XXX here'
+    >>> c = ChunkColorizer('XXX')
+    >>> c.colorize(line.encode()) == CreateColorizedLogLine(line, 'XXX').encode()
+    True
+    """
+
+    # The same fields as |reg|, but no field may span a newline. The pattern
+    # starts with a literal '[' (so the regex engine can skip ahead to
+    # candidates quickly) followed by a lookbehind which anchors it to the
+    # start of a line.
+    regex = re.compile(
+        rb'\[(?<![^\n]\[)\d+:\d+:\d+/\d+.\d+:([^:\n]+):([^\]\n]+)\] (.*)$',
+        re.MULTILINE)
+
+    levels = {
+        b'ERROR': (b'E', bcolors.FAIL),
+        b'WARNING': (b'W', bcolors.WARNING),
+        b'INFO': (b'I', bcolors.OKGREEN),
+    }
+
+    def __init__(self, highlight_text=None):
+        """|highlight_text| may be a string or a Highlighter."""
+        self.highlighter = Highlighter.Create(highlight_text)
+        end_color = bcolors.ENDC.encode()
+        # level -> (start color, abbreviated level + '> ', end color).
+        self.formats = {}
+        for (level, (abbrev, color)) in ChunkColorizer.levels.items():
+            self.formats[level] = (color.encode(), abbrev + b'> ', end_color)
+
+    def _replace(self, m):
+        # Called once per log line so this avoids %-formatting, which is
+        # noticeably slower than concatenation for bytes.
+        (level, source, message) = m.groups()
+        fmt = self.formats.get(level)
+        if fmt:
+            (start_color, level, end_color) = fmt
+        else:
+            start_color = end_color = b''
+            level += b'> '
+        if self.highlighter:
+            start_color = self.highlighter.color(message) or start_color
+        return start_color + level + source + b': ' + message + end_color
+
+    def colorize(self, chunk):
+        return ChunkColorizer.regex.sub(self._replace, chunk)
+
+
+def StreamColorizedLogLines(f, out, highlight_text=None,
+                            chunk_size=default_chunk_size):
+    """Colorize the binary file |f| writing one batch per chunk to |out|.
+
+    Returns the number of input bytes processed."""
+    colorizer = ChunkColorizer(highlight_text)
+    num_bytes = 0
+    for chunk in ReadLineChunks(f, chunk_size):
+        num_bytes += len(chunk)
+        if not chunk.endswith(b'\n'):
+            chunk += b'\n'
+        out.write(colorizer.colorize(chunk))
+    out.flush()
+    return num_bytes
+
+
+def SplitFileRanges(f, range_size):
+    r"""Split the binary file |f| into (offset, length) ranges of roughly
+    |range_size| bytes, each of which starts at the beginning of a line.
+
+    >>> import io
+    >>> SplitFileRanges(io.BytesIO(b'aaa\nbbb\nccc\n'), 5)
+    [(0, 8), (8, 4)]
+    >>> SplitFileRanges(io.BytesIO(b''), 5)
+    []
+    """
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    ranges = []
+    start = 0
+    while start < file_size:
+        end = start + range_size
+        if end >= file_size:
+            end = file_size
+        else:
+            f.seek(end)
+            f.readline()
+            end = f.tell()
+        ranges.append((start, end - start))
+        start = end
+    return ranges
+
+
+def _ColorizeRange(args):
+    """Process pool worker: colorize one byte range of a log file."""
+    (path, offset, length, highlight_text) = args
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        chunk = f.read(length)
+    if chunk and not chunk.endswith(b'\n'):
+        chunk += b'\n'
+    return ChunkColorizer(highlight_text).colorize(chunk)
+
+
+def ParallelColorizedLogLines(path, out, highlight_text=None, jobs=None,
+                              range_size=default_chunk_size):
+    """Colorize the log file at |path| using a pool of |jobs| processes.
+
+    The file is split into newline-aligned byte ranges which the workers
+    colorize independently. Results are written in the original order.
+    Returns the number of input bytes processed."""
+    with open(path, 'rb') as f:
+        ranges = SplitFileRanges(f, range_size)
+    work = [(path, offset, length, highlight_text)
+            for (offset, length) in ranges]
+    with multiprocessing.Pool(jobs) as pool:
+        # Results come back in submission order. The workers run at most a
+        # window of ranges ahead of |out|, so a slow reader does not make
+        # the colorized log pile up in memory.
+        window = 2 * (jobs or os.cpu_count() or 1)
+        for colorized in _WindowedMap(pool, _ColorizeRange,
+                                      [(w,) for w in work], window):
+            out.write(colorized)
+    out.flush()
+    return sum(length for (_, length) in ranges)
+
+
+def Benchmark(path, highlight_text=None, jobs=1):
+    """Print the throughput of the per-line and the streaming engines."""
+    num_bytes = os.path.getsize(path)
+    with open(os.devnull, 'w') as out:
+        with open(path, errors='replace') as f:
+            start = time.perf_counter()
+            for line in f:
+                print(CreateColorizedLogLine(line, highlight_text), file=out)
+            line_secs = time.perf_counter() - start
+    with open(os.devnull, 'wb') as out:
+        with open(path, 'rb') as f:
+            start = time.perf_counter()
+            StreamColorizedLogLines(f, out, highlight_text)
+            stream_secs = time.perf_counter() - start
+    results = [('per-line', line_secs), ('streaming', stream_secs)]
+    if jobs != 1:
+        with open(os.devnull, 'wb') as out:
+            start = time.perf_counter()
+            ParallelColorizedLogLines(path, out, highlight_text, jobs)
+            results.append(('parallel', time.perf_counter() - start))
+    mb = num_bytes / (1024.0 * 1024.0)
+    for (name, secs) in results:
+        print('%-10s %8.1f MB/s (%.1f MB in %.2fs)' %
+              (name, mb / secs if secs else 0.0, mb, secs))
+
+
+def HashLogRecords(f):
+    """Hash the normalized (level, source, message) record of every line.
+
+    Lines are split the same way as SplitLogLine(), so the date/time prefix
+    does not take part in the comparison. Lines that are not log lines are
+    hashed as-is. Returns (hashes, offsets) where offsets[i] is the byte
+    offset of line i in |f| and offsets[-1] is the file size."""
+    hashes = array.array('q')
+    offsets = array.array('q', [0])
+    offset = 0
+    match = breg.match
+    for chunk in ReadLineChunks(f):
+        for line in chunk.splitlines(True):
+            offset += len(line)
+            offsets.append(offset)
+            m = match(line)
+            hashes.append(hash(m.groups() if m else line.rstrip(b'\r\n')))
+    return (hashes, offsets)
+
+
+def _FindMiddleSnake(a, a_lo, a_hi, b, b_lo, b_hi):
+    """Find the middle snake of the shortest edit script for
+    a[a_lo:a_hi] -> b[b_lo:b_hi] using linear space.
+
+    Returns (d, x, y, u, v): the edit distance and the snake from (x, y) to
+    (u, v), relative to (a_lo, b_lo). See Myers, "An O(ND) Difference
+    Algorithm and Its Variations" (1986), section 4b."""
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) // 2
+    offset = max_d + 1
+    # Furthest x reached on each diagonal, forward and backward. The backward
+    # x is the distance from the end of a.
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                           forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            (x0, y0) = (x, y)
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1:
+                if x + backward[offset + delta - k] >= n:
+                    return (2 * d - 1, x0, y0, x, y)
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                           backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            (x0, y0) = (x, y)
+            while (x < n and y < m and
+                   a[a_hi - x - 1] == b[b_hi - y - 1]):
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d:
+                if x + forward[offset + delta - k] >= n:
+                    return (2 * d, n - x, m - y, n - x0, m - y0)
+    raise AssertionError('no middle snake')
+
+
+def DiffSequences(a, b):
+    """Return the (a_start, a_end, b_start, b_end) regions where the
+    sequences |a| and |b| differ.
+
+    Uses Myers' linear space refinement, so memory is O(len(a) + len(b))
+    and time is O((len(a) + len(b)) * D) for D differences.
+
+    >>> DiffSequences([1, 2, 3, 4], [1, 3, 4, 5])
+    [(1, 2, 1, 1), (4, 4, 3, 4)]
+    >>> DiffSequences('abcabba', 'cbabac')
+    [(0, 1, 0, 1), (2, 3, 2, 2), (5, 6, 4, 4), (7, 7, 5, 6)]
+    >>> DiffSequences([1, 2], [1, 2])
+    []
+    """
+    regions = []
+
+    def add(a_lo, a_hi, b_lo, b_hi):
+        # Merge with the previous region when they touch.
+        if regions and regions[-1][1] == a_lo and regions[-1][3] == b_lo:
+            regions[-1] = (regions[-1][0], a_hi, regions[-1][2], b_hi)
+        else:
+            regions.append((a_lo, a_hi, b_lo, b_hi))
+
+    # An explicit stack instead of recursion. Popped in order, so regions
+    # are produced from the start of the files to the end.
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        (a_lo, a_hi, b_lo, b_hi) = stack.pop()
+        # Skip the common prefix and suffix. In logs which mostly match
+        # this is where nearly all of the lines go.
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+        if a_lo == a_hi or b_lo == b_hi:
+            if a_lo != a_hi or b_lo != b_hi:
+                add(a_lo, a_hi, b_lo, b_hi)
+            continue
+        (d, x, y, u, v) = _FindMiddleSnake(a, a_lo, a_hi, b, b_lo, b_hi)
+        stack.append((a_lo + u, a_hi, b_lo + v, b_hi))
+        stack.append((a_lo, a_lo + x, b_lo, b_lo + y))
+    return regions
+
+
+def _NormalizeLogLine(line):
+    m = breg.match(line)
+    if m:
+        line = b'%s> %s: %s' % m.groups()
+    return line.rstrip(b'\r\n')
+
+
+def DiffLogs(path_a, path_b, out):
+    """Write the regions where two logs differ (ignoring the date/time
+    prefix) to the binary stream |out|.
+
+    Returns 0 if the logs match and 1 otherwise (like diff)."""
+    with open(path_a, 'rb') as f:
+        (hashes_a, offsets_a) = HashLogRecords(f)
+    with open(path_b, 'rb') as f:
+        (hashes_b, offsets_b) = HashLogRecords(f)
+    regions = DiffSequences(hashes_a, hashes_b)
+    if out.isatty():
+        (removed, added, end) = (bcolors.FAIL.encode(),
+                                 bcolors.OKGREEN.encode(),
+                                 bcolors.ENDC.encode())
+    else:
+        removed = added = end = b''
+    with open(path_a, 'rb') as file_a, open(path_b, 'rb') as file_b:
+        for (a_lo, a_hi, b_lo, b_hi) in regions:
+            out.write(b'@@ -%d,%d +%d,%d @@\n' %
+                      (a_lo + 1, a_hi - a_lo, b_lo + 1, b_hi - b_lo))
+            for (f, offsets, lo, hi, prefix, color) in (
+                    (file_a, offsets_a, a_lo, a_hi, b'-', removed),
+                    (file_b, offsets_b, b_lo, b_hi, b'+', added)):
+                f.seek(offsets[lo])
+                for line in f.read(offsets[hi] - offsets[lo]).splitlines():
+                    out.write(color + prefix + _NormalizeLogLine(line) + end +
+                              b'\n')
+    out.flush()
+    return 1 if regions else 0
+
+
+class BadLogIndex(Exception):
+    pass
+
+
+class LogIndex(object):
+    """A columnar on-disk index of every record in a log file.
+
+    Layout: a magic line, a JSON header line, padding to an 8 byte boundary,
+    then each column as a packed array. Levels and source files are stored
+    as ids into the header's string tables. A record extends from its
+    offset to the next record's offset, so lines without a log prefix
+    (i.e. multi-line messages) stay with the record they belong to.
+
+    Columns are memory-mapped and read through memoryview casts, so opening
+    an index does not read it.
+    """
+
+    magic = b'CRLIDX 1\n'
+
+    # (name, array typecode). offset has one extra entry: the log size.
+    columns = [
+        ('offset', 'q'),
+        ('pid', 'I'),
+        ('tid', 'q'),
+        ('month_day', 'H'),
+        ('time_us', 'q'),
+        ('level', 'B'),
+        ('source_file', 'I'),
+        ('line_number', 'I'),
+    ]
+
+    @staticmethod
+    def IndexPath(log_path):
+        return log_path + '.crlidx'
+
+    @staticmethod
+    def Build(log_path, index_path=None):
+        """Parse the log once and write its index. Returns the index path."""
+        index_path = index_path or LogIndex.IndexPath(log_path)
+        cols = dict((name, array.array(typecode))
+                    for (name, typecode) in LogIndex.columns)
+        levels = {}
+        sources = {}
+        offset = 0
+        with open(log_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            for chunk in ReadLineChunks(f):
+                for line in chunk.splitlines(True):
+                    try:
+                        r = ParseLogLine(line)
+                    except BadLogLine:
+                        offset += len(line)
+                        continue
+                    cols['offset'].append(offset)
+                    cols['pid'].append(r.pid)
+                    cols['tid'].append(r.tid)
+                    cols['month_day'].append(r.month_day)
+                    cols['time_us'].append(r.time_us)
+                    cols['level'].append(levels.setdefault(r.level,
+                                                           len(levels)))
+                    cols['source_file'].append(
+                        sources.setdefault(r.source_file, len(sources)))
+                    cols['line_number'].append(r.line_number)
+                    offset += len(line)
+        cols['offset'].append(offset)
+        header = {
+            'log_size': st.st_size,
+            'log_mtime_ns': st.st_mtime_ns,
+            'num_records': len(cols['pid']),
+            'levels': [l.decode('utf-8', 'replace') for l in levels],
+            'source_files': [s.decode('utf-8', 'replace') for s in sources],
+        }
+        with open(index_path, 'wb') as f:
+            f.write(LogIndex.magic)
+            f.write(json.dumps(header).encode() + b'\n')
+            f.write(b'\0' * (-f.tell() % 8))
+            for (name, _) in LogIndex.columns:
+                cols[name].tofile(f)
+                f.write(b'\0' * (-f.tell() % 8))
+        return index_path
+
+    def __init__(self, log_path, index_path=None):
+        """Open the index for |log_path|, building it if missing or stale."""
+        self.log_path = log_path
+        index_path = index_path or LogIndex.IndexPath(log_path)
+        st = os.stat(log_path)
+        if not self._open(index_path):
+            LogIndex.Build(log_path, index_path)
+            self._open(index_path)
+        if (self.header['log_size'] != st.st_size or
+                self.header['log_mtime_ns'] != st.st_mtime_ns):
+            self.close()
+            LogIndex.Build(log_path, index_path)
+            self._open(index_path)
+
+    def _open(self, index_path):
+        try:
+            with open(index_path, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if self.mm[:len(LogIndex.magic)] != LogIndex.magic:
+            raise BadLogIndex(index_path)
+        header_end = self.mm.find(b'\n', len(LogIndex.magic)) + 1
+        self.header = json.loads(self.mm[len(LogIndex.magic):header_end])
+        pos = header_end + (-header_end % 8)
+        view = memoryview(self.mm)
+        num_records = self.header['num_records']
+        self.cols = {}
+        for (name, typecode) in LogIndex.columns:
+            count = num_records + 1 if name == 'offset' else num_records
+            size = count * array.array(typecode).itemsize
+            self.cols[name] = view[pos:pos + size].cast(typecode)
+            pos += size + (-size % 8)
+        return True
+
+    def close(self):
+        # The column views must be released before the mmap can close.
+        for col in self.cols.values():
+            col.release()
+        self.cols = {}
+        self.mm.close()
+
+    def Query(self, levels=None, source_glob=None, pid=None):
+        """Yield the (start, end) byte range of every matching record."""
+        cols = self.cols
+        num_records = self.header['num_records']
+        if levels:
+            wanted = set(levels)
+            ids = [i for (i, l) in enumerate(self.header['levels'])
+                   if l in wanted]
+            # Map the wanted level ids to 1 and everything else to 0 so that
+            # candidates can be found with C speed bytes searches.
+            table = bytearray(256)
+            for i in ids:
+                table[i] = 1
+            flags = cols['level'].tobytes().translate(table)
+            candidates = (m.start() for m in re.finditer(b'\x01', flags))
+        else:
+            candidates = range(num_records)
+        if source_glob:
+            # Match the glob against the (small) source table once, not
+            # against every record.
+            source_ids = set(i for (i, s) in
+                             enumerate(self.header['source_files'])
+                             if fnmatch.fnmatchcase(s, source_glob))
+        offsets = cols['offset']
+        pids = cols['pid']
+        source_files = cols['source_file']
+        for i in candidates:
+            if pid is not None and pids[i] != pid:
+                continue
+            if source_glob and source_files[i] not in source_ids:
+                continue
+            yield (offsets[i], offsets[i + 1])
+
+
+def ParseLogRecords(f):
+    """Yield a LogRecord for every record in the binary file |f|.
+
+    Lines without a log prefix are appended (with a newline) to the message
+    of the record before them. Such lines before the first record are
+    dropped."""
+    record = None
+    extra = []
+    for chunk in ReadLineChunks(f):
+        for line in chunk.splitlines(True):
+            try:
+                next_record = ParseLogLine(line)
+            except BadLogLine:
+                if record:
+                    extra.append(line.rstrip(b'\r\n'))
+                continue
+            if record:
+                if extra:
+                    record = record._replace(
+                        message=b'\n'.join([record.message] + extra))
+                    extra = []
+                yield record
+            record = next_record
+    if record:
+        if extra:
+            record = record._replace(
+                message=b'\n'.join([record.message] + extra))
+        yield record
+
+
+def ExportJsonLines(f, out):
+    """Write every record of the binary log |f| as a JSON object per line
+    to the text stream |out|."""
+    for r in ParseLogRecords(f):
+        out.write(json.dumps({
+            'pid': r.pid,
+            'tid': r.tid,
+            'month_day': r.month_day,
+            'time_us': r.time_us,
+            'level': r.level.decode('utf-8', 'replace'),
+            'source_file': r.source_file.decode('utf-8', 'replace'),
+            'line_number': r.line_number,
+            'message': r.message.decode('utf-8', 'replace'),
+        }) + '\n')
+
+
+class SpillBuffer(object):
+    """An append-only buffer whose contents are moved to an anonymous
+    temporary file in |spill_dir| by each spill().
+
+    |data| (an array.array or bytearray) holds what has been appended since
+    the last spill.
+
+    >>> import io
+    >>> b = SpillBuffer(array.array('H', [1]))
+    >>> b.spill()
+    >>> b.data.append(2)
+    >>> b.size()
+    4
+    >>> out = io.BytesIO()
+    >>> b.copy_to(out)
+    >>> array.array('H', out.getvalue()).tolist()
+    [1, 2]
+    >>> b.close()
+    """
+
+    def __init__(self, data, spill_dir=None):
+        self.data = data
+        self.file = tempfile.TemporaryFile(dir=spill_dir)
+        self.spilled = 0
+
+    def spill(self):
+        self.file.write(self.data)
+        self.spilled += len(self.data) * getattr(self.data, 'itemsize', 1)
+        del self.data[:]
+
+    def size(self):
+        """Total bytes appended, spilled or not."""
+        return self.spilled + len(self.data) * getattr(self.data, 'itemsize',
+                                                       1)
+
+    def copy_to(self, out):
+        self.spill()
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, out, compressed_read_size)
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarExport(object):
+    """Write the records of a log to a columnar binary file.
+
+    Layout: a magic line, 8 byte aligned column buffers, a JSON footer and
+    finally the footer's length as a little-endian uint64. The footer lists
+    every buffer with its file offset, length and numpy style dtype, so a
+    notebook can load each column with a single numpy.memmap() call.
+
+    Like Arrow: level and source_file are dictionary encoded (the footer
+    holds the dictionary, the buffer holds the ids) and message is a
+    variable length string column stored as an int64 offsets buffer (one
+    more entry than records) plus a UTF-8 data buffer.
+    """
+
+    magic = b'CRLCOL 1\n'
+
+    # Fixed width columns: (name, array typecode).
+    columns = [
+        ('pid', 'I'),
+        ('tid', 'q'),
+        ('month_day', 'H'),
+        ('time_us', 'q'),
+        ('level', 'I'),
+        ('source_file', 'I'),
+        ('line_number', 'I'),
+    ]
+
+    @staticmethod
+    def _dtype(typecode):
+        byte_order = '<' if sys.byteorder == 'little' else '>'
+        return '%s%s%d' % (byte_order, 'i' if typecode.islower() else 'u',
+                           array.array(typecode).itemsize)
+
+    # Records buffered in memory before the columns are spilled.
+    spill_records = 64 * 1024
+
+    @staticmethod
+    def Write(f, out_path):
+        """Export the binary log |f| to |out_path|.
+
+        Each buffer is spilled to its own temporary file (next to
+        |out_path|) as it grows, and the files are concatenated at the end,
+        so memory use does not grow with the size of the log."""
+        spill_dir = os.path.dirname(os.path.abspath(out_path))
+        cols = dict((name, SpillBuffer(array.array(typecode), spill_dir))
+                    for (name, typecode) in ColumnarExport.columns)
+        dictionaries = {'level': {}, 'source_file': {}}
+        message_offsets = SpillBuffer(array.array('q', [0]), spill_dir)
+        message_data = SpillBuffer(bytearray(), spill_dir)
+        buffers = [(name, cols[name], ColumnarExport._dtype(typecode))
+                   for (name, typecode) in ColumnarExport.columns]
+        buffers.append(('message.offsets', message_offsets,
+                        ColumnarExport._dtype('q')))
+        buffers.append(('message.data', message_data, '|u1'))
+        try:
+            num_records = 0
+            message_end = 0
+            for r in ParseLogRecords(f):
+                cols['pid'].data.append(r.pid)
+                cols['tid'].data.append(r.tid)
+                cols['month_day'].data.append(r.month_day)
+                cols['time_us'].data.append(r.time_us)
+                for (name, values) in dictionaries.items():
+                    cols[name].data.append(values.setdefault(
+                        getattr(r, name), len(values)))
+                cols['line_number'].data.append(r.line_number)
+                message_data.data += r.message
+                message_end += len(r.message)
+                message_offsets.data.append(message_end)
+                num_records += 1
+                if num_records % ColumnarExport.spill_records == 0:
+                    for (_, buf, _) in buffers:
+                        buf.spill()
+                elif len(message_data.data) >= default_chunk_size:
+                    message_data.spill()
+            footer = {
+                'num_records': num_records,
+                'dictionaries': dict(
+                    (name, [v.decode('utf-8', 'replace') for v in values])
+                    for (name, values) in dictionaries.items()),
+                'buffers': [],
+            }
+            with open(out_path, 'wb') as out:
+                out.write(ColumnarExport.magic)
+                for (name, buf, dtype) in buffers:
+                    out.write(b'\0' * (-out.tell() % 8))
+                    footer['buffers'].append({
+                        'name': name,
+                        'dtype': dtype,
+                        'offset': out.tell(),
+                        'length': buf.size(),
+                    })
+                    buf.copy_to(out)
+                encoded = json.dumps(footer).encode()
+                out.write(encoded)
+                out.write(struct.pack('<Q', len(encoded)))
+        finally:
+            for (_, buf, _) in buffers:
+                buf.close()
+
+    @staticmethod
+    def Read(path):
+        """Return (footer, {buffer name: memoryview}) for an exported file.
+
+        A stdlib-only reader; notebooks would use numpy instead."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(ColumnarExport.magic):
+            raise ValueError('%s is not a columnar log export' % path)
+        (footer_len,) = struct.unpack('<Q', data[-8:])
+        footer = json.loads(data[-8 - footer_len:-8])
+        typecodes = dict(ColumnarExport.columns)
+        typecodes['message.offsets'] = 'q'
+        view = memoryview(data)
+        buffers = {}
+        for b in footer['buffers']:
+            buf = view[b['offset']:b['offset'] + b['length']]
+            if b['name'] in typecodes:
+                buf = buf.cast(typecodes[b['name']])
+            buffers[b['name']] = buf
+        return (footer, buffers)
+
+
+def QueryLog(log_path, out, levels=None, source_glob=None, pid=None,
+             highlight_text=None):
+    """Write the records of |log_path| matching the query to |out|."""
+    index = LogIndex(log_path)
+    colorizer = ChunkColorizer(highlight_text)
+    with open(log_path, 'rb') as f:
+        if not index.header['log_size']:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            batch = []
+            for (start, end) in index.Query(levels, source_glob, pid):
+                batch.append(log[start:end])
+                if len(batch) >= 4096:
+                    out.write(colorizer.colorize(b''.join(batch)))
+                    batch = []
+            chunk = b''.join(batch)
+            if chunk and not chunk.endswith(b'\n'):
+                chunk += b'\n'
+            out.write(colorizer.colorize(chunk))
+    index.close()
+    out.flush()
+
+
+class LogFollower(object):
+    """Colorize a log as it grows, like "tail -f".
+
+    Only the bytes appended since the last read are parsed. A partial last
+    line is held back until its newline arrives. Truncation (the file
+    shrinks) restarts from the beginning, and rotation (a new file takes the
+    path) finishes the old file and then switches to the new one.
+
+    On Linux the follower sleeps in inotify until the log's directory
+    reports a change, so an idle log costs no CPU. Elsewhere it falls back
+    to polling the file's size every |poll_interval| seconds.
+    """
+
+    def __init__(self, path, out, highlight_text=None, poll_interval=0.5):
+        self.path = os.path.abspath(path)
+        self.out = out
+        self.colorizer = ChunkColorizer(highlight_text)
+        self.poll_interval = poll_interval
+        self.f = None
+        self.inode = None
+        self.partial = b''
+
+    def _open(self, from_end):
+        if self.f:
+            self.f.close()
+            self.f = None
+        self.partial = b''
+        try:
+            self.f = open(self.path, 'rb')
+        except FileNotFoundError:
+            # Rotated away and not yet recreated.
+            return
+        self.inode = os.fstat(self.f.fileno()).st_ino
+        if from_end:
+            self.f.seek(0, os.SEEK_END)
+
+    def _read_appended(self):
+        """Colorize and write everything appended since the last read."""
+        if not self.f:
+            return
+        if os.fstat(self.f.fileno()).st_size < self.f.tell():
+            # Truncated: start over at the beginning.
+            self.f.seek(0)
+            self.partial = b''
+        data = self.f.read()
+        if not data:
+            return
+        data = self.partial + data
+        idx = data.rfind(b'\n')
+        self.partial = data[idx + 1:]
+        if idx != -1:
+            self.out.write(self.colorizer.colorize(data[:idx + 1]))
+            self.out.flush()
+
+    def _check_rotated(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return
+        if inode != self.inode or not self.f:
+            # Drain whatever was written to the old file before switching.
+            self._read_appended()
+            if self.partial:
+                self.out.write(self.colorizer.colorize(self.partial + b'\n'))
+            self._open(from_end=False)
+
+    def run(self):
+        self._open(from_end=True)
+        if not Inotify.Supported():
+            while True:
+                time.sleep(self.poll_interval)
+                self._check_rotated()
+                self._read_appended()
+        inotify = Inotify()
+        # Watch the directory rather than the file so that rotation
+        # (create/rename of a new file at the path) is seen as well.
+        mask = (Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE |
+                Inotify.IN_CREATE | Inotify.IN_MOVED_TO |
+                Inotify.IN_MOVED_FROM | Inotify.IN_DELETE | Inotify.IN_ATTRIB)
+        inotify.add_watch(os.path.dirname(self.path), mask)
+        name = os.fsencode(os.path.basename(self.path))
+        try:
+            while True:
+                # One wakeup drains all queued events and then reads all
+                # appended bytes at once, so the cost per wakeup stays
+                # constant no matter how fast the log is written.
+                events = inotify.read_events()
+                if not any(event_name == name or
+                           mask & Inotify.IN_Q_OVERFLOW
+                           for (_, mask, event_name) in events):
+                    continue
+                self._check_rotated()
+                self._read_appended()
+        finally:
+            inotify.close()
+
+
+class TopCounter(object):
+    """Approximate counts of the most frequent items in bounded memory.
+
+    At most 2 * |capacity| items are kept. When that fills up only the
+    |capacity| most frequent survive, and items seen afterwards start at
+    the largest evicted count. Counts are therefore upper bounds, and exact
+    for any item which has never been evicted.
+
+    >>> c = TopCounter(capacity=2)
+    >>> c.update({'a': 5, 'b': 3, 'c': 1, 'd': 1, 'e': 1})
+    >>> c.most_common(2)
+    [('a', 5), ('b', 3)]
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.floor = 0
+
+    def update(self, counts):
+        mine = self.counts
+        for (item, count) in counts.items():
+            if item in mine:
+                mine[item] += count
+            else:
+                mine[item] = self.floor + count
+        if len(mine) > 2 * self.capacity:
+            keep = heapq.nlargest(self.capacity, mine.items(),
+                                  key=lambda kv: kv[1])
+            self.floor = max(self.floor, keep[-1][1])
+            self.counts = dict(keep)
+
+    def most_common(self, n):
+        return heapq.nlargest(n, self.counts.items(), key=lambda kv: kv[1])
+
+
+class LogStats(object):
+    """Line and byte counts of a log, gathered in one streaming pass.
+
+    Each chunk is parsed with one findall() and the columns are counted with
+    Counter, whose counting loop runs in C. Counts are kept per
+    (pid, level, source file), per second of log time, and per message with
+    its digits removed (so "took 12ms" and "took 9ms" count together). The
+    message counter is a TopCounter, so memory stays bounded however many
+    distinct messages there are. Stats from separate parts of a log can be
+    merged, which is how --jobs gathers them in parallel.
+    """
+
+    regex = re.compile(
+        rb'(\[(?<![^\n]\[)(\d+):\d+:(\d+)/(\d+).\d+:([^:\n]+):'
+        rb'([^\]\n(]*)[^\]\n]*\] (.*))$', re.MULTILINE)
+
+    digits = b'0123456789'
+
+    def __init__(self):
+        # (pid, level, source file) -> count.
+        self.lines = collections.Counter()
+        self.bytes = collections.Counter()
+        # (MMDD, HHMMSS) -> lines.
+        self.seconds = collections.Counter()
+        self.messages = TopCounter()
+        self.other_lines = 0
+        self.other_bytes = 0
+
+    def add_chunk(self, chunk):
+        r"""Count the lines of |chunk|, which ends at a line end or (for
+        the last chunk of a log) at the end of the log.
+
+        >>> stats = LogStats()
+        >>> stats.add_chunk(b'x\n[1:2:0114/114420.990441:INFO:a.cc(1)] a')
+        >>> (sum(stats.lines.values()), sum(stats.bytes.values()),
+        ...  stats.other_lines, stats.other_bytes)
+        (1, 39, 1, 2)
+        """
+        # The last line of a log may have no newline.
+        unterminated = chunk and not chunk.endswith(b'\n')
+        if unterminated:
+            chunk += b'\n'
+        records = LogStats.regex.findall(chunk)
+        self.other_lines += chunk.count(b'\n') - len(records)
+        if not records:
+            self.other_bytes += len(chunk) - unterminated
+            return
+        (lines, pids, month_days, times, levels, sources,
+         messages) = zip(*records)
+        keys = list(zip(pids, levels, sources))
+        self.lines.update(keys)
+        num_bytes = self.bytes
+        total = 0
+        for (key, length) in zip(keys, map(len, lines)):
+            # +1 for the newline.
+            num_bytes[key] += length + 1
+            total += length + 1
+        self.other_bytes += len(chunk) - total
+        if unterminated:
+            # Take back the added newline from whichever line got it.
+            if chunk.endswith(lines[-1] + b'\n'):
+                num_bytes[keys[-1]] -= 1
+            else:
+                self.other_bytes -= 1
+        self.seconds.update(zip(month_days, times))
+        self.messages.update(collections.Counter(
+            map(bytes.translate, messages, itertools.repeat(None),
+                itertools.repeat(LogStats.digits))))
+
+    def merge(self, other):
+        self.lines.update(other.lines)
+        self.bytes.update(other.bytes)
+        self.seconds.update(other.seconds)
+        self.messages.update(other.messages.counts)
+        self.other_lines += other.other_lines
+        self.other_bytes += other.other_bytes
+
+    def _totals(self, field):
+        """Sum lines and bytes by one field of the (pid, level, source)
+        key. Returns [(value, lines, bytes)] sorted by most lines first."""
+        lines = collections.Counter()
+        num_bytes = collections.Counter()
+        for (key, count) in self.lines.items():
+            lines[key[field]] += count
+            num_bytes[key[field]] += self.bytes[key]
+        return [(value, count, num_bytes[value])
+                for (value, count) in lines.most_common()]
+
+    def report(self, out, top=20, bucket_secs=60):
+        total_lines = sum(self.lines.values())
+        total_bytes = sum(self.bytes.values())
+        out.write('%d log lines (%.1f MB), %d other lines (%.1f MB)\n' %
+                  (total_lines, total_bytes / 1048576.0, self.other_lines,
+                   self.other_bytes / 1048576.0))
+        for (title, field, limit) in (('level', 1, None),
+                                      ('source file', 2, top),
+                                      ('pid', 0, top)):
+            totals = self._totals(field)
+            out.write('\nBy %s%s:\n' %
+                      (title, ' (top %d of %d)' % (limit, len(totals))
+                       if limit and len(totals) > limit else ''))
+            out.write('%10s %7s %10s  %s\n' % ('lines', '%', 'bytes', title))
+            for (value, count, num_bytes) in totals[:limit]:
+                out.write('%10d %6.2f%% %10d  %s\n' %
+                          (count, 100.0 * count / total_lines, num_bytes,
+                           value.decode('utf-8', 'replace')))
+        out.write('\nTop %d messages (digits removed):\n' % top)
+        for (message, count) in self.messages.most_common(top):
+            out.write('%10d  %s\n' %
+                      (count, message.decode('utf-8', 'replace')[:100]))
+        buckets = collections.Counter()
+        for ((month_day, hhmmss), count) in self.seconds.items():
+            hhmmss = int(hhmmss)
+            secs = (hhmmss // 10000) * 3600 + (hhmmss // 100 % 100) * 60 + \
+                hhmmss % 100
+            buckets[(int(month_day), secs - secs % bucket_secs)] += count
+        if not buckets:
+            return
+        out.write('\nLines per second (%ds buckets):\n' % bucket_secs)
+        peak = max(buckets.values())
+        for (month_day, secs) in sorted(buckets):
+            count = buckets[(month_day, secs)]
+            out.write('%04d %02d:%02d:%02d %10.1f %s\n' %
+                      (month_day, secs // 3600, secs // 60 % 60, secs % 60,
+                       float(count) / bucket_secs, '#' * (50 * count // peak)))
+
+
+def _StatsRange(args):
+    """Process pool worker: gather LogStats for one byte range of a log."""
+    (path, offset, length) = args
+    stats = LogStats()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        stats.add_chunk(f.read(length))
+    return stats
+
+
+def GatherLogStats(path, jobs=1):
+    stats = LogStats()
+    if jobs == 1 or GetCompression(path):
+        with OpenLogFile(path, jobs) as f:
+            for chunk in ReadLineChunks(f):
+                stats.add_chunk(chunk)
+        return stats
+    with open(path, 'rb') as f:
+        ranges = SplitFileRanges(f, default_chunk_size)
+    with multiprocessing.Pool(jobs) as pool:
+        work = [(path, offset, length) for (offset, length) in ranges]
+        for range_stats in pool.imap_unordered(_StatsRange, work):
+            stats.merge(range_stats)
+    return stats
+
+
+# Smaller than default_chunk_size because --merge may have hundreds of files
+# open at once.
+merge_chunk_size = 256 * 1024
+
+
+def TimestampedRecords(f):
+    r"""Yield a ((MMDD, HHMMSS, fraction), record) tuple for every record in
+    the binary file |f|.
+
+    A record is a log line plus any following lines without a log prefix.
+    Lines before the first record sort before everything else.
+
+    >>> import io
+    >>> list(TimestampedRecords(io.BytesIO(
+    ...     b'[1:2:0114/114420.990441:INFO:a.cc(1)] a\nmore\n')))
+    [((114, 114420, 990441), b'[1:2:0114/114420.990441:INFO:a.cc(1)] a\nmore\n')]
+    """
+    key = (0, 0, 0)
+    record = []
+    match = time_reg.match
+    for chunk in ReadLineChunks(f, merge_chunk_size):
+        if not chunk.endswith(b'\n'):
+            chunk += b'\n'
+        for line in chunk.splitlines(True):
+            m = match(line)
+            if not m:
+                record.append(line)
+                continue
+            if record:
+                yield (key, b''.join(record))
+            key = (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            record = [line]
+    if record:
+        yield (key, b''.join(record))
+
+
+def MergeLogs(paths, out):
+    """Merge the logs at |paths| into one log ordered by timestamp.
+
+    A heap based k-way merge reads each file lazily, so memory is
+    proportional to the number of files rather than their size. Records
+    with equal timestamps keep the order of |paths|. The output keeps the
+    original lines, so it is itself a log that can be colorized, indexed
+    etc.
+
+    Compressed inputs are decompressed sequentially into a one block queue
+    each: the many inputs already keep the CPUs busy, and a parallel
+    decompressor per input would hold several blocks of every file in
+    memory."""
+    with contextlib.ExitStack() as stack:
+        inputs = [TimestampedRecords(stack.enter_context(
+                      OpenLogFile(p, 1, queue_size=1)))
+                  for p in paths]
+        batch = []
+        for (_, record) in heapq.merge(*inputs, key=lambda r: r[0]):
+            batch.append(record)
+            if len(batch) >= 4096:
+                out.write(b''.join(batch))
+                batch = []
+        out.write(b''.join(batch))
+    out.flush()
+
+
+def ExportLogs(paths, fmt, output=None, jobs=1):
+    for path in paths:
+        out_path = output or '%s.%s' % (path, 'jsonl' if fmt == 'jsonl'
+                                         else 'crlcol')
+        with OpenLogFile(path, jobs) as f:
+            if fmt == 'columnar':
+                ColumnarExport.Write(f, out_path)
+            elif out_path == '-':
+                ExportJsonLines(f, sys.stdout)
+            else:
+                with open(out_path, 'w') as out:
+                    ExportJsonLines(f, out)
+
+
+def ParseArgs():
+    desc = """
+    Strip the date/time prefix from, and colorize, Chromium log lines.
+    """
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='Log files to read (default: stdin)')
+    parser.add_argument('--highlight', action='append',
+                        help='Highlight messages containing this text '
+                        '(repeatable, default: XXX)')
+    parser.add_argument('--highlight-file',
+                        help='File of "[color,] text" or "[color,] /regex/" '
+                        'lines to highlight')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes to colorize files with, or '
+                        'threads to decompress multi-member gzip and '
+                        'seekable zstd files with (0 = one per CPU)')
+    parser.add_argument('--diff', action='store_true',
+                        help='Show where two logs differ, ignoring the '
+                        'date/time prefix')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='Output appended lines as the file grows')
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the files into one log ordered by '
+                        'timestamp')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print line/byte counts by level, source file '
+                        'and pid, top messages and a log rate histogram')
+    parser.add_argument('--bucket', type=int, default=60,
+                        help='Stats: rate histogram bucket size in seconds')
+    parser.add_argument('--export', choices=['jsonl', 'columnar'],
+                        help='Write every parsed field of each record to '
+                        '<file>.jsonl or <file>.crlcol')
+    parser.add_argument('-o', '--output',
+                        help='Export: output path ("-" = stdout for jsonl)')
+    parser.add_argument('--index', action='store_true',
+                        help='(Re)build the query index of each file')
+    parser.add_argument('--query', action='store_true',
+                        help='Print only the records matching --level, '
+                        '--source and --pid using the index (built if '
+                        'needed)')
+    parser.add_argument('--level', action='append',
+                        help='Query: log level, e.g. ERROR (repeatable)')
+    parser.add_argument('--source',
+                        help='Query: source file glob, e.g. "bluetooth_*.cc"')
+    parser.add_argument('--pid', type=int, help='Query: process id')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Print per-line vs. streaming throughput (MB/s)')
+    parser.add_argument('--test', action='store_true',
+                        help='Run the doctests and exit')
+    return parser.parse_args()
+
+
+def main():
+    args = ParseArgs()
+    if args.test:
+        import doctest
+        doctest.testmod()
+        return
+    if args.highlight_file:
+        try:
+            args.highlight = Highlighter.FromFile(args.highlight_file,
+                                                  args.highlight or [])
+        except (OSError, ValueError, re.error) as e:
+            print('%s: %s' % (args.highlight_file, e), file=sys.stderr)
+            sys.exit(2)
+    elif args.highlight:
+        args.highlight = Highlighter([(t, bcolors.OKBLUE)
+                                      for t in args.highlight])
+    else:
+        args.highlight = 'XXX'
+    # multiprocessing.Pool() uses one process per CPU when given None.
+    jobs = args.jobs if args.jobs > 0 else None
+    if args.benchmark:
+        for path in args.files:
+            print(path)
+            Benchmark(path, args.highlight, jobs)
+        return
+    out = sys.stdout.buffer
+    try:
+        if args.diff or args.follow or args.index or args.query:
+            for path in args.files:
+                if GetCompression(path):
+                    print('%s: compressed logs are only supported when '
+                          'colorizing and with --merge, --stats and --export'
+                          % path,
+                          file=sys.stderr)
+                    sys.exit(2)
+        if args.diff:
+            if len(args.files) != 2:
+                print('--diff requires two files', file=sys.stderr)
+                sys.exit(2)
+            sys.exit(DiffLogs(args.files[0], args.files[1], out))
+        if args.follow:
+            if len(args.files) != 1:
+                print('--follow requires one file', file=sys.stderr)
+                sys.exit(2)
+            LogFollower(args.files[0], out, args.highlight).run()
+        if args.merge:
+            MergeLogs(args.files, out)
+            return
+        if args.stats:
+            stats = LogStats()
+            for path in args.files:
+                stats.merge(GatherLogStats(path, jobs))
+            stats.report(sys.stdout, bucket_secs=args.bucket)
+            return
+        if args.export:
+            if args.output and len(args.files) > 1:
+                print('--output requires a single input file',
+                      file=sys.stderr)
+                sys.exit(2)
+            if args.export == 'columnar' and args.output == '-':
+                print('columnar exports cannot be written to stdout',
+                      file=sys.stderr)
+                sys.exit(2)
+            ExportLogs(args.files, args.export, args.output, jobs)
+            return
+        if args.index:
+            for path in args.files:
+                LogIndex.Build(path)
+            return
+        if args.query:
+            for path in args.files:
+                QueryLog(path, out, args.level, args.source, args.pid,
+                         args.highlight)
+            return
+        if not args.files:
+            StreamColorizedLogLines(sys.stdin.buffer, out, args.highlight)
+        for path in args.files:
+            if path == '-':
+                StreamColorizedLogLines(sys.stdin.buffer, out, args.highlight)
+                continue
+            if jobs != 1 and not GetCompression(path):
+                ParallelColorizedLogLines(path, out, args.highlight, jobs)
+                continue
+            with OpenLogFile(path, jobs) as f:
+                StreamColorizedLogLines(f, out, args.highlight)
+    except BrokenPipeError:
+        # Output piped to something like head which exited early.
+        sys.stderr.close()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
+import argparse
+import concurrent.futures
+import hashlib
+import json
 import os
 import platform
 import subprocess
 import sys
-from go import Go
+import threading
+import time
+from go import Checkouts, NewGo
 
 
 # TODO: Investigate switching to https://pypi.org/project/clrprint/
@@ -104,7 +110,7 @@ class Cmd(object):
 
 
 def GetChromiumSrcDir():
-    g = Go(os.path.abspath(os.getcwd()))
+    g = NewGo(os.path.abspath(os.getcwd()))
     return g.getval('c') # Return path to Chromium source dir.
 
 
@@ -137,14 +143,122 @@ def GitBranchExists(branch_name, src_dir):
         return False
 
 
-def RunCmd(cmd, working_dir):
+def HistoryPath():
+    return os.path.expanduser('~/.crsync-history.jsonl')
+
+
+class CmdHistory(object):
+    '''Appends a JSON line per command run by RunCmd, with its wall time,
+    child CPU time, max RSS and bytes written (from the child's rusage).
+    Every command of one crsync run shares a sync id.'''
+    lock = threading.Lock()
+    sync_id = '%d-%d' % (time.time(), os.getpid())
+
+    @staticmethod
+    def StepName(cmd):
+        '''"git fetch", "gclient sync" etc.'''
+        name = os.path.splitext(os.path.basename(cmd[0]))[0]
+        return '%s %s' % (name, cmd[1]) if len(cmd) > 1 else name
+
+    @staticmethod
+    def Append(record):
+        line = json.dumps(record) + '\n'
+        with CmdHistory.lock:
+            try:
+                with open(HistoryPath(), 'a') as f:
+                    f.write(line)
+            except OSError:
+                pass
+
+    @staticmethod
+    def Read():
+        records = []
+        try:
+            with open(HistoryPath()) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return records
+
+
+def RunCmd(cmd, working_dir, env=None):
     Cmd.print_ok(cmd)
-    subprocess.check_call(cmd, cwd=working_dir)
+    record = {
+        'sync': CmdHistory.sync_id,
+        'step': CmdHistory.StepName(cmd),
+        'cmd': cmd,
+        'cwd': working_dir,
+        'start': time.time(),
+    }
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, cwd=working_dir, env=env)
+    if hasattr(os, 'wait4'):
+        # wait4 gives the rusage of this child alone, even while other
+        # threads are running commands.
+        (_, status, usage) = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        scale = 1 if platform.system() == 'Darwin' else 1024
+        record.update({
+            'user': usage.ru_utime,
+            'sys': usage.ru_stime,
+            'max_rss': usage.ru_maxrss * scale,
+            'bytes_written': usage.ru_oublock * 512,
+        })
+    else:
+        proc.wait()
+    record['wall'] = time.monotonic() - start
+    record['returncode'] = proc.returncode
+    CmdHistory.Append(record)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def PrintHistorySummary(last_syncs=10):
+    '''Print per-step statistics and the most recent syncs from the command
+    history.'''
+    records = CmdHistory.Read()
+    if not records:
+        print('No history in %s' % HistoryPath())
+        return
+    steps = {}
+    for r in records:
+        steps.setdefault(r['step'], []).append(r)
+    Cmd.print_info('Per step (wall seconds):')
+    print('  %-20s %5s %8s %8s %8s %8s %9s' %
+          ('step', 'runs', 'mean', 'min', 'last', 'cpu', 'max rss'))
+    for (step, runs) in sorted(steps.items()):
+        walls = [r['wall'] for r in runs]
+        cpu = [r.get('user', 0) + r.get('sys', 0) for r in runs]
+        print('  %-20s %5d %8.1f %8.1f %8.1f %8.1f %8.0fM' %
+              (step, len(runs), sum(walls) / len(walls), min(walls),
+               walls[-1], sum(cpu) / len(cpu),
+               max(r.get('max_rss', 0) for r in runs) / 2**20))
+    syncs = {}
+    for r in records:
+        syncs.setdefault(r['sync'], []).append(r)
+    Cmd.print_info('Recent syncs:')
+    for (sync, runs) in sorted(syncs.items(),
+                               key=lambda i: i[1][0]['start'])[-last_syncs:]:
+        end = max(r['start'] + r['wall'] for r in runs)
+        written = sum(r.get('bytes_written', 0) for r in runs)
+        print('  %s  %7.1fs  %3d commands  %8.1fM written%s' %
+              (time.strftime('%Y-%m-%d %H:%M', time.localtime(
+                  runs[0]['start'])), end - runs[0]['start'], len(runs),
+               written / 2**20,
+               '  FAILED' if any(r['returncode'] for r in runs) else ''))
 
 
 def UpdateChromium(src_dir):
     Cmd.print_info('Fetching source from Chromium origin.')
     RunCmd([GitPath(), 'fetch', 'origin'], working_dir=src_dir)
+    RebaseMain(src_dir)
+
+
+def CheckoutMain(src_dir):
     if not GitBranchExists('main', src_dir):
         Cmd.print_info('Creating main branch.')
         RunCmd([
@@ -153,21 +267,496 @@ def UpdateChromium(src_dir):
                working_dir=src_dir)
     Cmd.print_info('Checking out main branch.')
     RunCmd([GitPath(), 'checkout', 'main'], working_dir=src_dir)
+
+
+def RebaseMain(src_dir):
+    CheckoutMain(src_dir)
     Cmd.print_info('Rebasing main branch.')
     RunCmd([GitPath(), 'rebase', 'origin/main'], working_dir=src_dir)
 
 
-def GClientSync(src_dir):
-    Cmd.print_info('Syncing all Chromium dependencies.')
+def GitOutput(args, src_dir):
+    '''Return the stripped output of git |args|, or None if it fails.'''
+    try:
+        output = subprocess.check_output([GitPath()] + args,
+                                         cwd=src_dir,
+                                         stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+    return output.decode().strip()
+
+
+def RemoteMain(repo_dir, remote='origin'):
+    '''Return the SHA of main on |remote| (one ls-remote round trip).'''
+    output = GitOutput(['ls-remote', remote, 'refs/heads/main'], repo_dir)
+    return output.split()[0] if output else None
+
+
+def MainIsCurrent(src_dir):
+    '''Return True if main is checked out and already contains origin/main.'''
+    if GitOutput(['symbolic-ref', '--short', 'HEAD'], src_dir) != 'main':
+        return False
+    return subprocess.call(
+        [GitPath(), 'merge-base', '--is-ancestor', 'origin/main', 'main'],
+        cwd=src_dir) == 0
+
+
+class SyncState(object):
+    '''The inputs of the last successful gclient sync of a checkout, kept in
+    .git/crsync-state.json so that an unchanged sync can be skipped.'''
+
+    def __init__(self, src_dir):
+        self.src_dir = src_dir
+        # Not src/.git: that is a file in a worktree.
+        git_dir = GitOutput(['rev-parse', '--absolute-git-dir'], src_dir)
+        self.path = (os.path.join(git_dir, 'crsync-state.json')
+                     if git_dir else None)
+        self.state = {}
+        if self.path:
+            try:
+                with open(self.path) as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def _gclient_inputs(self):
+        try:
+            with open(os.path.join(os.path.dirname(self.src_dir),
+                                   '.gclient'), 'rb') as f:
+                gclient = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            gclient = None
+        return {
+            'head': GitOutput(['rev-parse', 'HEAD'], self.src_dir),
+            'deps': GitOutput(['rev-parse', 'HEAD:DEPS'], self.src_dir),
+            'gclient': gclient,
+        }
+
+    def gclient_is_current(self):
+        return self.state.get('gclient_inputs') == self._gclient_inputs()
+
+    def record_sync(self):
+        self.state['origin_main'] = GitOutput(['rev-parse', 'origin/main'],
+                                              self.src_dir)
+        self.state['gclient_inputs'] = self._gclient_inputs()
+        self.state['time'] = time.time()
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self.state, f, indent=2)
+        except OSError as e:
+            Cmd.print_error('Unable to save the sync state: %s' % e)
+
+
+def FastSync(src_dir):
+    '''Like UpdateChromium followed by GClientSync, but skip the steps whose
+    inputs have not changed since the last sync.'''
+    state = SyncState(src_dir)
+    remote = RemoteMain(src_dir)
+    if remote and remote == GitOutput(['rev-parse', 'origin/main'], src_dir):
+        Cmd.print_info('origin/main is current (%s), not fetching.' %
+                       remote[:12])
+    else:
+        Cmd.print_info('Fetching source from Chromium origin.')
+        RunCmd([GitPath(), 'fetch', 'origin'], working_dir=src_dir)
+    if MainIsCurrent(src_dir):
+        Cmd.print_info('main already contains origin/main, not rebasing.')
+    else:
+        RebaseMain(src_dir)
+    if state.gclient_is_current():
+        Cmd.print_info('HEAD, DEPS and .gclient are unchanged since the last '
+                       'sync, not running gclient.')
+    else:
+        GClientSync(src_dir)
+        state.record_sync()
+
+
+class FastSyncFixture(object):
+    '''A throwaway checkout of a local bare origin, with a stub gclient,
+    for testing which steps FastSync skips. Each sync() returns the steps
+    that ran.
+
+    >>> with FastSyncFixture() as f:
+    ...     f.sync()
+    ...     f.sync()
+    ...     f.push('DEPS')
+    ...     f.sync()
+    ...     f.push('README')
+    ...     f.sync()
+    ...     f.edit_gclient()
+    ...     f.sync()
+    ...     SyncState(f.add_worktree()).record_sync()
+    ...     SyncState(f.worktree).gclient_is_current()
+    ['gclient sync']
+    []
+    ['git fetch', 'git checkout', 'git rebase', 'gclient sync']
+    ['git fetch', 'git checkout', 'git rebase', 'gclient sync']
+    ['gclient sync']
+    True
+    '''
+
+    def __enter__(self):
+        import shutil
+        import tempfile
+        self.tmp = tempfile.mkdtemp(prefix='crsync-test-')
+        self.git = shutil.which('git')
+        self.origin = os.path.join(self.tmp, 'origin.git')
+        self.work = os.path.join(self.tmp, 'work')
+        self.src_dir = os.path.join(self.tmp, 'checkout', 'src')
+        self.worktree = os.path.join(self.tmp, 'worktree', 'src')
+        gclient = os.path.join(self.tmp, 'bin', 'gclient')
+        os.makedirs(os.path.dirname(gclient))
+        with open(gclient, 'w') as f:
+            f.write('#!/bin/sh\nexit 0\n')
+        os.chmod(gclient, 0o755)
+        self.saved = {
+            name: globals()[name]
+            for name in ('GitPath', 'GClientPath', 'HistoryPath')
+        }
+        globals().update({
+            'GitPath': lambda: self.git,
+            'GClientPath': lambda: gclient,
+            'HistoryPath': lambda: os.path.join(self.tmp, 'history.jsonl'),
+        })
+        self._git('init', '-q', '--bare', self.origin)
+        self._git('symbolic-ref', 'HEAD', 'refs/heads/main', cwd=self.origin)
+        self._git('init', '-q', self.work)
+        self.push('DEPS')
+        self._git('clone', '-q', self.origin, self.src_dir)
+        self.edit_gclient()
+        return self
+
+    def __exit__(self, *exc_info):
+        import shutil
+        globals().update(self.saved)
+        shutil.rmtree(self.tmp)
+
+    def _git(self, *args, cwd=None):
+        subprocess.check_call([self.git] + list(args),
+                              cwd=cwd or self.tmp,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    def push(self, name):
+        '''Commit a change to |name| and push it to origin's main.'''
+        with open(os.path.join(self.work, name), 'a') as f:
+            f.write('%s\n' % time.time())
+        self._git('add', name, cwd=self.work)
+        self._git('-c', 'user.name=crsync', '-c', 'user.email=crsync@test',
+                  'commit', '-q', '-m', name, cwd=self.work)
+        self._git('push', '-q', self.origin, 'HEAD:refs/heads/main',
+                  cwd=self.work)
+
+    def edit_gclient(self):
+        with open(os.path.join(os.path.dirname(self.src_dir), '.gclient'),
+                  'a') as f:
+            f.write('# %s\n' % time.time())
+
+    def add_worktree(self):
+        '''Add a worktree, whose .git is a file, and return its path.'''
+        self._git('worktree', 'add', '-q', '--detach', self.worktree,
+                  cwd=self.src_dir)
+        return self.worktree
+
+    def sync(self):
+        import contextlib
+        import io
+        start = len(CmdHistory.Read())
+        # Quiet both the printed commands and the commands themselves.
+        saved = [os.dup(1), os.dup(2)]
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        try:
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+            with contextlib.redirect_stdout(io.StringIO()):
+                FastSync(self.src_dir)
+        finally:
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved + [devnull]:
+                os.close(fd)
+        return [r['step'] for r in CmdHistory.Read()[start:]]
+
+
+def GClientSyncCmd():
     if platform.system() == 'Windows':
         # Git on Windows is sloooow.
-        cmd = [GClientPath(), 'sync', '-D']
+        return [GClientPath(), 'sync', '-D']
+    return [GClientPath(), 'sync', '-D', '--with_branch_heads']
+
+
+def GClientSync(src_dir):
+    Cmd.print_info('Syncing all Chromium dependencies.')
+    RunCmd(GClientSyncCmd(), working_dir=src_dir)
+
+
+class Pipeline(object):
+    '''Run named steps, each after the steps it depends on, on a bounded
+    pool of worker threads, and record the wall time of each step.'''
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.steps = {}  # name -> (func, deps)
+        self.times = {}  # name -> (start, end), relative to run().
+        self.lock = threading.Lock()
+        self.wall_time = 0.0
+
+    def add(self, name, func, deps=()):
+        for dep in deps:
+            assert dep in self.steps, dep
+        self.steps[name] = (func, tuple(deps))
+
+    def _run_step(self, name, origin):
+        start = time.monotonic() - origin
+        try:
+            self.steps[name][0]()
+        finally:
+            with self.lock:
+                self.times[name] = (start, time.monotonic() - origin)
+
+    def run(self):
+        '''Run all steps. The first failure stops new steps from starting and
+        is re-raised once the running ones finish.'''
+        origin = time.monotonic()
+        done = set()
+        running = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+                while len(done) < len(self.steps):
+                    for (name, (_, deps)) in self.steps.items():
+                        if name not in done and \
+                                name not in running.values() and \
+                                all(d in done for d in deps):
+                            running[pool.submit(self._run_step, name,
+                                                origin)] = name
+                    (finished, _) = concurrent.futures.wait(
+                        running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        done.add(running.pop(future))
+                        if future.exception():
+                            concurrent.futures.wait(running)
+                            raise future.exception()
+        finally:
+            self.wall_time = time.monotonic() - origin
+
+    def critical_path(self):
+        '''Return the chain of steps, ending with the last to finish, in
+        which each step waited on the previous one.'''
+        path = []
+        name = max(self.times, key=lambda n: self.times[n][1])
+        while name:
+            path.append(name)
+            deps = self.steps[name][1]
+            name = max(deps, key=lambda n: self.times[n][1]) if deps else None
+        return list(reversed(path))
+
+    def report(self):
+        Cmd.print_info('Step times:')
+        for (name, (start, end)) in sorted(self.times.items(),
+                                           key=lambda i: i[1]):
+            print('  %-16s %7.1fs  (%.1fs - %.1fs)' %
+                  (name, end - start, start, end))
+        path = self.critical_path()
+        serial = sum(end - start for (start, end) in self.times.values())
+        print('Critical path: %s (%.1fs)' %
+              (' -> '.join(path),
+               sum(self.times[n][1] - self.times[n][0] for n in path)))
+        print('Wall time: %.1fs, %.1fs if run one at a time (saved %.1fs)' %
+              (self.wall_time, serial, serial - self.wall_time))
+
+
+def FetchDepsCmd(src_dir, jobs):
+    '''Command fetching every git dependency except the src solution itself,
+    which the pipeline fetches separately; two fetches in one repo at once
+    can fail on ref locks.'''
+    root = os.path.basename(os.path.normpath(src_dir))
+    fetch = ('import os, subprocess, sys\n'
+             'if os.environ.get("GCLIENT_DEP_PATH") != %r:\n'
+             '    sys.exit(subprocess.call([%r, "fetch", "--quiet"]))\n' %
+             (root, GitPath()))
+    return [
+        GClientPath(), 'recurse', '--scm', 'git', '-j',
+        str(jobs), sys.executable, '-c', fetch
+    ]
+
+
+def PipelinedSync(src_dir, jobs):
+    '''Sync like UpdateChromium followed by GClientSync, but fetch the
+    dependencies (as currently pinned) while the main repo is fetched, and
+    run the hooks as a separate step.'''
+    pipeline = Pipeline(jobs)
+    pipeline.add('fetch', lambda: RunCmd([GitPath(), 'fetch', 'origin'],
+                                         working_dir=src_dir))
+    pipeline.add('fetch deps', lambda: RunCmd(FetchDepsCmd(src_dir, jobs),
+                                              working_dir=src_dir))
+    pipeline.add('checkout', lambda: CheckoutMain(src_dir), deps=['fetch'])
+    pipeline.add('rebase', lambda: RunCmd(
+        [GitPath(), 'rebase', 'origin/main'], working_dir=src_dir),
+                 deps=['checkout'])
+    pipeline.add('gclient sync', lambda: RunCmd(
+        GClientSyncCmd() + ['--nohooks', '-j', str(jobs)],
+        working_dir=src_dir),
+                 deps=['rebase', 'fetch deps'])
+    pipeline.add('runhooks', lambda: RunCmd([GClientPath(), 'runhooks'],
+                                            working_dir=src_dir),
+                 deps=['gclient sync'])
+    try:
+        pipeline.run()
+    finally:
+        if pipeline.times:
+            pipeline.report()
+
+
+def DefaultMirrorDir():
+    return os.path.expanduser('~/src/chromium-mirror')
+
+
+def UpdateMirror(mirror_dir, url):
+    '''Create or update a bare mirror of |url| in |mirror_dir| and return
+    its path.'''
+    mirror = os.path.join(mirror_dir, 'src.git')
+    if not os.path.isdir(mirror):
+        Cmd.print_info('Creating the shared mirror of %s.' % url)
+        os.makedirs(mirror_dir, exist_ok=True)
+        RunCmd([GitPath(), 'clone', '--mirror', url, mirror],
+               working_dir=mirror_dir)
+    elif RemoteMain(mirror) == GitOutput(['rev-parse', 'refs/heads/main'],
+                                         mirror):
+        Cmd.print_info('The shared mirror is current.')
     else:
-        cmd = [GClientPath(), 'sync', '-D', '--with_branch_heads']
-    RunCmd(cmd, working_dir=src_dir)
+        Cmd.print_info('Updating the shared mirror.')
+        RunCmd([GitPath(), 'fetch', 'origin'], working_dir=mirror)
+    return mirror
+
+
+def UseAlternates(src_dir, mirror):
+    '''Let the checkout at |src_dir| borrow objects from |mirror|.
+
+    The mirror must never be pruned (git gc --prune) while checkouts borrow
+    from it.'''
+    path = os.path.join(src_dir, '.git', 'objects', 'info', 'alternates')
+    objects = os.path.join(mirror, 'objects')
+    try:
+        with open(path) as f:
+            if objects in f.read().splitlines():
+                return
+    except FileNotFoundError:
+        pass
+    with open(path, 'a') as f:
+        f.write(objects + '\n')
+
+
+def SyncFromMirror(src_dir, mirror, cache_dir, fetch_limit, force):
+    '''Update |src_dir| from the (already updated) |mirror|, fetching the
+    dependencies through the gclient git cache in |cache_dir|.'''
+    UseAlternates(src_dir, mirror)
+    Cmd.print_info('Fetching %s from the shared mirror.' % src_dir)
+    RunCmd([
+        GitPath(), 'fetch', mirror, '+refs/heads/main:refs/remotes/origin/main'
+    ],
+           working_dir=src_dir)
+    if force or not MainIsCurrent(src_dir):
+        RebaseMain(src_dir)
+    state = SyncState(src_dir)
+    if not force and state.gclient_is_current():
+        Cmd.print_info('%s is current.' % src_dir)
+        return
+    with fetch_limit:
+        Cmd.print_info('Syncing dependencies of %s.' % src_dir)
+        RunCmd(GClientSyncCmd(),
+               working_dir=src_dir,
+               env=dict(os.environ, GIT_CACHE_PATH=cache_dir))
+    state.record_sync()
+
+
+def BatchSync(src_dirs, mirror_dir, jobs, fetch_jobs, force):
+    '''Sync all |src_dirs|, |jobs| at a time, with at most |fetch_jobs|
+    gclient syncs (which fetch from the network) running at once.
+
+    The main repo is fetched once into a shared mirror, which the checkouts
+    use as an alternate object store and fetch from locally. Dependencies
+    are shared through gclient's git cache (GIT_CACHE_PATH).'''
+    url = subprocess.check_output(
+        [GitPath(), 'config', 'remote.origin.url'],
+        cwd=src_dirs[0]).decode().strip()
+    mirror = UpdateMirror(mirror_dir, url)
+    cache_dir = os.path.join(mirror_dir, 'git-cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    fetch_limit = threading.Semaphore(fetch_jobs)
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = dict((pool.submit(SyncFromMirror, src_dir, mirror,
+                                    cache_dir, fetch_limit, force), src_dir)
+                       for src_dir in src_dirs)
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception():
+                Cmd.print_error('%s: %s' %
+                                (futures[future], future.exception()))
+                failed.append(futures[future])
+    if failed:
+        sys.exit(1)
+
+
+def ParseArgs():
+    parser = argparse.ArgumentParser(
+        description='Update the Chromium checkout and its dependencies.')
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help='Overlap independent steps and report where '
+                        'the time went')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Maximum parallel steps and gclient jobs, or '
+                        'checkouts synced at once')
+    parser.add_argument('-c', '--checkout', action='append', default=[],
+                        help='Sync this checkout (see go.py --checkouts) '
+                        'through the shared mirror (repeatable)')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='Sync every checkout through the shared mirror')
+    parser.add_argument('--fetch-jobs', type=int, default=2,
+                        help='Maximum checkouts fetching dependencies at once')
+    parser.add_argument('--force', action='store_true',
+                        help='Run every step even if its inputs (remote '
+                        'main, DEPS, .gclient) are unchanged since the last '
+                        'sync')
+    parser.add_argument('--history', action='store_true',
+                        help='Summarize the timing history of past syncs '
+                        'and exit')
+    parser.add_argument('--mirror-dir', default=DefaultMirrorDir(),
+                        help='Shared mirror and git cache directory')
+    parser.add_argument('--test', action='store_true',
+                        help='Run the doctests (against a local bare origin '
+                        'and a stub gclient) and exit')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+    args = ParseArgs()
+    if args.test:
+        import doctest
+        sys.exit(1 if doctest.testmod().failed else 0)
+    if args.history:
+        PrintHistorySummary()
+        sys.exit(0)
+    if args.checkout or args.all:
+        checkouts = Checkouts().by_name()
+        names = sorted(checkouts) if args.all else args.checkout
+        if not names:
+            Cmd.print_error('No checkouts found.')
+            sys.exit(2)
+        unknown = [n for n in names if n not in checkouts]
+        if unknown:
+            Cmd.print_error('Unknown checkouts: %s' % ', '.join(unknown))
+            sys.exit(2)
+        BatchSync([checkouts[n] for n in names], args.mirror_dir, args.jobs,
+                  args.fetch_jobs, args.force)
+        sys.exit(0)
     chromium_src_dir = GetChromiumSrcDir()
-    UpdateChromium(chromium_src_dir)
-    GClientSync(chromium_src_dir)
+    if args.pipeline:
+        PipelinedSync(chromium_src_dir, args.jobs)
+    elif args.force:
+        UpdateChromium(chromium_src_dir)
+        GClientSync(chromium_src_dir)
+        SyncState(chromium_src_dir).record_sync()
+    else:
+        FastSync(chromium_src_dir)
@@ -3,7 +3,6 @@
 from __future__ import print_function
 
 import argparse
-import re
 import subprocess
 import sys
 
@@ -55,6 +54,7 @@ class BranchInfo(object):
     self.rebased = False
     self.ahead = None
     self.behind = None
+    self.sha = None
 
   def isLocalBranch(self):
     # TODO: Get origin names
@@ -82,54 +82,50 @@ class Git(object):
           info.behind = int(vals[1])
 
   def getBranches(self):
+    """Return {name: BranchInfo} of the local branches and their upstreams
+    from a single for-each-ref."""
     branches = {}
-    cmd = ['git', '--no-pager', 'branch', '--list', '-v', '-v']
+    cmd = ['git', 'for-each-ref',
+           '--format=%(refname:short)%00%(upstream:short)%00'
+           '%(upstream:track,nobracket)%00%(objectname)', 'refs/heads']
     for line in subprocess.check_output(cmd).splitlines():
-      line = line.decode('utf-8')
-      if line.startswith('*'):
-        line = line.lstrip('*')
-      line = line.strip()
-      m = re.search(r'^(\S+)\s+(\S+)\s+\[([^\]]+)\].*$', line)
-      if m:
-        branchName = m.group(1)
-        items = m.group(3).split(':')
-        parentBranchName = items[0]
-        if parentBranchName == branchName:
-          print("Branch is recursive: %s" % branchName, file=sys.stderr)
-          branches[branchName] = BranchInfo(branchName, None)
-          continue
-        if parentBranchName not in branches:
-          branches[parentBranchName] = BranchInfo(parentBranchName, None)
-        if branchName in branches:
-          info = branches[branchName]
-          info.parent = parentBranchName
-          assert parentBranchName != branchName
-          if len(items) > 1:
-            Git.parseAheadBehind(info, items[1])
-        else:
-          info = BranchInfo(branchName, parentBranchName)
-          if len(items) > 1:
-            Git.parseAheadBehind(info, items[1])
-          branches[branchName] = info
+      (branchName, parentBranchName, track, sha) = \
+          line.decode('utf-8').split('\0')
+      if not parentBranchName:
+        continue
+      if parentBranchName == branchName:
+        print("Branch is recursive: %s" % branchName, file=sys.stderr)
+        branches[branchName] = BranchInfo(branchName, None)
+        continue
+      if parentBranchName not in branches:
+        branches[parentBranchName] = BranchInfo(parentBranchName, None)
+      if branchName in branches:
+        info = branches[branchName]
+        info.parent = parentBranchName
+      else:
+        info = BranchInfo(branchName, parentBranchName)
+        branches[branchName] = info
+      info.sha = sha
+      Git.parseAheadBehind(info, track)
     return branches
 
+  def isUpToDate(self, branch, parent):
+    """Return True if the current tip of |parent| is already an ancestor of
+    |branch|."""
+    if not parent.rebased:
+      # Neither has moved since getBranches, so its count is still right.
+      return not branch.behind
+    # The branch has not been rebased (it is checked first), so its sha is
+    # still its tip. Merges are fine: this does not count commits.
+    return subprocess.call(['git', 'merge-base', '--is-ancestor',
+                            parent.name, branch.sha]) == 0
+
 class Rebaser(object):
   def __init__(self, opts):
     self.options = opts
     self.git = Git()
     self.rebase_warned_branches = set()
 
-  @staticmethod
-  def isBranchOrParentBehind(branches, branch):
-    while branch:
-      if branch.behind:
-        return True
-      if branch.parent in branches:
-        branch = branches[branch.parent]
-      else:
-        break
-    return False
-
   def prune(self):
     branches = self.git.getBranches()
     for branch in branches:
@@ -157,15 +153,11 @@ class Rebaser(object):
     if branch.name in self.options.skip_branches:
       print('Skipping branch "%s"' % branch.name)
       return
-    if not self.options.force and not Rebaser.isBranchOrParentBehind(branches, branch):
+    if not self.options.force and self.git.isUpToDate(branch, parent):
       print("Skipping rebase: %s is not behind %s" % (branch.name, branch.parent))
       return
-    cmd = ['git', '--no-pager', 'checkout', branch.name]
-    if self.options.print_cmds:
-      print(' '.join(cmd))
-    if not self.options.noop:
-      subprocess.check_output(cmd)
-    cmd = ['git', '--no-pager', 'rebase', parent.name]
+    # Naming the branch makes rebase check it out first.
+    cmd = ['git', '--no-pager', 'rebase', parent.name, branch.name]
     print("Rebasing %s onto %s" % (branch.name, parent.name))
     if self.options.print_cmds:
       print(' '.join(cmd))
@@ -2,13 +2,40 @@
 
 from __future__ import print_function
 
+import marshal
 import os
 import sys
+import time
+
+def ReadMarshaled(path):
+  """Return the value marshaled in |path|, or None if it can't be read."""
+  try:
+    with open(path, 'rb') as f:
+      return marshal.load(f)
+  except (OSError, EOFError, ValueError, TypeError):
+    return None
+
+def WriteMarshaled(path, value):
+  """Atomically replace |path| with marshaled |value|. The files are only
+  caches, so failure is ignored (and reported by returning False)."""
+  tmp_path = '%s.%d' % (path, os.getpid())
+  try:
+    with open(tmp_path, 'wb') as f:
+      marshal.dump(value, f)
+    os.replace(tmp_path, path)
+    return True
+  except OSError:
+    return False
 
 class NoRootException(Exception):
   """Thrown when the Chromium root directory cannot be determined."""
   pass
 
+class NeedsEnvironment(Exception):
+  """Thrown when a value uses environment variables, which only the
+  calling process can expand."""
+  pass
+
 class BadLength(Exception):
   """Thrown when value length != 2."""
   pass
@@ -16,6 +43,249 @@ class BadLength(Exception):
 class BadValue(Exception):
   pass
 
+class UnknownShortcut(Exception):
+  """Thrown when a shortcut is not in the shortcuts file."""
+  pass
+
+class ShortcutIndex:
+  """A sorted index of names for prefix and fuzzy (subsequence) matching.
+
+  >>> index = ShortcutIndex(['docs', 'crb', 'cr'])
+  >>> index.prefixed('cr')
+  ['cr', 'crb']
+  >>> index.prefixed('x')
+  []
+  >>> ShortcutIndex.fuzzy_score('dcs', 'docs') > 0
+  True
+  >>> ShortcutIndex.fuzzy_score('sd', 'docs')
+  0
+  >>> (ShortcutIndex.fuzzy_score('cb', 'chrome/browser') >
+  ...  ShortcutIndex.fuzzy_score('cb', 'chromeb'))
+  True
+  """
+  separators = '/\\-_. '
+
+  def __init__(self, names):
+    self.names = sorted(names)
+
+  def prefixed(self, prefix):
+    """Return the names starting with |prefix|, in sorted order."""
+    import bisect
+    matches = []
+    i = bisect.bisect_left(self.names, prefix)
+    while i < len(self.names) and self.names[i].startswith(prefix):
+      matches.append(self.names[i])
+      i += 1
+    return matches
+
+  @staticmethod
+  def fuzzy_score(query, candidate):
+    """Return how well |query| matches |candidate| as a subsequence (0 if it
+    does not). Consecutive characters and characters starting a word score
+    higher, and longer candidates score lower."""
+    score = 0
+    pos = 0
+    prev = -2
+    for c in query:
+      pos = candidate.find(c, pos)
+      if pos == -1:
+        return 0
+      score += 1
+      if pos == prev + 1:
+        score += 2
+      if pos == 0 or candidate[pos - 1] in ShortcutIndex.separators:
+        score += 3
+      prev = pos
+      pos += 1
+    return score * 100 // (100 + len(candidate))
+
+class Frecency:
+  """Visit counts and times of the directories go has resolved to, stored
+  in ~/.gohistory. Recent visits weigh more than old ones.
+
+  To keep lookups fast, record() only appends a line to ~/.gohistory.log,
+  and the history is only read when it is needed for ranking. The log is
+  folded into ~/.gohistory once it grows past |max_log_size|.
+
+  >>> f = Frecency('/nonexistent/gohistory')
+  >>> f.entries = {'/a': (3, 0.0), '/b': (1, 1000.0)}
+  >>> f.score('/a', 1000.0) > f.score('/b', 1000.0)
+  True
+  >>> f.score('/a', 1e9) < f.score('/b', 1e9)
+  False
+  >>> f.score('/c', 1000.0)
+  0
+  """
+  default_path = '~/.gohistory'
+  max_entries = 2000
+  max_log_size = 64 * 1024
+
+  def __init__(self, path=None):
+    self.path = os.path.expanduser(path or Frecency.default_path)
+    self.log_path = self.path + '.log'
+    self._entries = None
+
+  @property
+  def entries(self):
+    if self._entries is None:
+      entries = ReadMarshaled(self.path)
+      self._entries = entries if isinstance(entries, dict) else {}
+      try:
+        with open(self.log_path) as f:
+          for line in f:
+            (when, _, path) = line.rstrip('\n').partition('\t')
+            try:
+              self._add(path, float(when))
+            except ValueError:
+              pass
+      except OSError:
+        pass
+    return self._entries
+
+  @entries.setter
+  def entries(self, entries):
+    self._entries = entries
+
+  def _add(self, path, when):
+    (count, _) = self._entries.get(path, (0, 0.0))
+    self._entries[path] = (count + 1, when)
+
+  def score(self, path, now=None):
+    entry = self.entries.get(path)
+    if not entry:
+      return 0
+    (count, last) = entry
+    age = (now or time.time()) - last
+    if age < 3600:
+      return count * 4
+    if age < 86400:
+      return count * 2
+    if age < 7 * 86400:
+      return count / 2
+    return count / 4
+
+  def record(self, path):
+    now = time.time()
+    if self._entries is not None:
+      self._add(path, now)
+    try:
+      with open(self.log_path, 'a') as f:
+        f.write(str.format('{0}\t{1}\n', now, path))
+        log_size = f.tell()
+    except OSError:
+      return
+    if log_size > Frecency.max_log_size:
+      self.compact()
+
+  def compact(self):
+    """Fold the log into the history, forgetting the least valuable
+    entries when there are too many."""
+    entries = self.entries
+    if len(entries) > Frecency.max_entries:
+      now = time.time()
+      ranked = sorted(entries, key=lambda p: self.score(p, now))
+      for p in ranked[:len(ranked) - Frecency.max_entries * 3 // 4]:
+        del entries[p]
+    if WriteMarshaled(self.path, entries):
+      try:
+        os.remove(self.log_path)
+      except OSError:
+        pass
+
+class Checkouts:
+  """All Chromium checkouts under the base directories in $GO_CHECKOUT_DIRS
+  (os.pathsep separated, default ~/src), found by a parallel, depth-limited
+  scan and cached in ~/.gocheckouts for a day.
+
+  A checkout is named after its root directory, or after the parent of a
+  root named "src" (the gclient layout), so ~/src/beta/src is "beta".
+
+  >>> Checkouts.name_of('/home/me/src/beta/src')
+  'beta'
+  >>> Checkouts.name_of('/home/me/chromium')
+  'chromium'
+  """
+  default_path = '~/.gocheckouts'
+  max_age = 86400
+  max_depth = 4
+  pruned = frozenset(['out', 'third_party', 'node_modules'])
+  required_items = frozenset(['.git', 'chrome', 'content', 'components',
+                              'android_webview', 'DEPS'])
+
+  def __init__(self, path=None):
+    self.path = os.path.expanduser(path or Checkouts.default_path)
+    self.bases = [os.path.abspath(os.path.expanduser(d)) for d in
+                  os.environ.get('GO_CHECKOUT_DIRS', '~/src').split(os.pathsep)
+                  if d]
+    self.roots = None
+    cached = ReadMarshaled(self.path)
+    if isinstance(cached, tuple) and len(cached) == 3:
+      (bases, scanned, roots) = cached
+      if bases == self.bases and time.time() - scanned < Checkouts.max_age:
+        self.roots = roots
+
+  @staticmethod
+  def name_of(root):
+    if os.path.basename(root) == 'src':
+      return os.path.basename(os.path.dirname(root))
+    return os.path.basename(root)
+
+  @staticmethod
+  def _scan_dir(path):
+    """Return (is_root, subdirectories) of |path| with a single scandir."""
+    names = []
+    subdirs = []
+    try:
+      with os.scandir(path) as it:
+        for entry in it:
+          names.append(entry.name)
+          if entry.name.startswith('.') or entry.name in Checkouts.pruned:
+            continue
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              subdirs.append(entry.path)
+          except OSError:
+            pass
+    except OSError:
+      return (False, [])
+    return (Checkouts.required_items.issubset(names), subdirs)
+
+  def scan(self, jobs=16):
+    """Scan the base directories, one directory level at a time with
+    |jobs| threads, and cache the roots found."""
+    from concurrent.futures import ThreadPoolExecutor
+    roots = []
+    level = [d for d in self.bases if os.path.isdir(d)]
+    with ThreadPoolExecutor(jobs) as pool:
+      for _ in range(Checkouts.max_depth + 1):
+        next_level = []
+        for (path, (is_root, subdirs)) in zip(
+            level, pool.map(Checkouts._scan_dir, level)):
+          if is_root:
+            # Nested checkouts are not supported.
+            roots.append(path)
+          else:
+            next_level.extend(subdirs)
+        level = next_level
+    self.roots = sorted(roots)
+    WriteMarshaled(self.path, (self.bases, time.time(), self.roots))
+    return self.roots
+
+  def by_name(self):
+    """Return {name: root} of the checkouts, scanning if not cached."""
+    if self.roots is None:
+      self.scan()
+    return dict((Checkouts.name_of(r), r) for r in self.roots)
+
+  def find(self, name):
+    """Return the root of checkout |name|, rescanning once if it is not
+    known (or no longer exists), or None."""
+    root = self.by_name().get(name)
+    if root is None or not os.path.isdir(root):
+      self.scan()
+      root = self.by_name().get(name)
+    return root
+
 class Go:
   root_variable_name = '$CRROOT'
 
@@ -100,15 +370,49 @@ class Go:
       return (shortcut, [v.strip() for v in values])
     return (shortcut, value)
 
-  def __init__(self, cwd):
-    self.shortcuts = {}
-    self.chromium_root_dir = Go.get_chrome_dir(cwd)
-    with open(os.path.expanduser('~/.goshortcuts')) as f:
+  @staticmethod
+  def ParseFile(path):
+    shortcuts = {}
+    with open(path) as f:
       for line in f:
         (shortcut, values) = Go.ParseLine(line)
         if not shortcut:
           continue
-        self.shortcuts[shortcut] = values
+        shortcuts[shortcut] = values
+    return shortcuts
+
+  @staticmethod
+  def LoadShortcuts(path):
+    """Return the shortcuts in |path|.
+
+    The parsed table is cached (marshaled) in |path|.cache along with the
+    mtime and size of |path|, and is only re-parsed when those change."""
+    st = os.stat(path)
+    cache_path = path + '.cache'
+    cached = ReadMarshaled(cache_path)
+    if isinstance(cached, tuple) and len(cached) == 3 and \
+        cached[:2] == (st.st_mtime_ns, st.st_size):
+      return cached[2]
+    shortcuts = Go.ParseFile(path)
+    WriteMarshaled(cache_path, (st.st_mtime_ns, st.st_size, shortcuts))
+    return shortcuts
+
+  def __init__(self, cwd, shortcuts=None, root_cache=None, history=None,
+               checkouts=None, expand_env=True):
+    """Raises NoRootException if the Chromium root cannot be determined.
+
+    A long-lived caller (see GoServer) may pass in the already loaded
+    |shortcuts|, |root_cache|, |history| and |checkouts|. Its environment is
+    not the caller's, so it passes |expand_env| False and values using
+    variables other than $CRROOT raise NeedsEnvironment."""
+    self.expand_env = expand_env
+    self.history = history or Frecency()
+    self.checkouts = checkouts
+    self.index = None
+    self.chromium_root_dir = (root_cache or RootCache()).get_chrome_dir(cwd)
+    if shortcuts is None:
+      shortcuts = Go.LoadShortcuts(os.path.expanduser('~/.goshortcuts'))
+    self.shortcuts = shortcuts
     if not self.chromium_root_dir:
       # Can't determine Chromium root directory based on current directory
       # so see if there is a shortcut with a value of $CRROOT and use it's
@@ -118,10 +422,8 @@ class Go:
         if isinstance(value, list) and value[0] == Go.root_variable_name:
           self.chromium_root_dir = value[1]
     if not self.chromium_root_dir:
-      print(str.format('Cannot find suitable value for "{0}"',
-                       Go.root_variable_name),
-            file=sys.stderr)
-      sys.exit(2)
+      raise NoRootException(str.format('Cannot find suitable value for "{0}"',
+                                       Go.root_variable_name))
 
   def do_print(self):
     # TODO: Don't hard-code the string length
@@ -133,34 +435,416 @@ class Go:
       if (isinstance(value, str) and userval != value) or isinstance(value, list):
         print(str.format("              {0}", userval), file=sys.stderr)
 
-  def expand_value(self, value):
+  def expand_value(self, value, root=None):
     assert isinstance(value, str)
     if Go.root_variable_name in value:
       if not self.root_variable_name:
         raise NoRootException
-      value = value.replace(Go.root_variable_name, self.chromium_root_dir)
+      value = value.replace(Go.root_variable_name,
+                            root or self.chromium_root_dir)
+    if '$' in value and not self.expand_env:
+      raise NeedsEnvironment(value)
     return os.path.expanduser(os.path.expandvars(value))
 
-  def getval(self, shortcut):
-    if shortcut in self.shortcuts:
-      value = self.shortcuts[shortcut]
-      if isinstance(value, str):
-        return self.expand_value(value)
-      try:
-        return self.expand_value(value[0])
-      except NoRootException:
-        return self.expand_value(value[1])
+  def expand_shortcut(self, shortcut, root=None):
+    value = self.shortcuts[shortcut]
+    if isinstance(value, str):
+      return self.expand_value(value, root)
+    if root:
+      return self.expand_value(value[0], root)
+    try:
+      return self.expand_value(value[0])
+    except NoRootException:
+      return self.expand_value(value[1])
+
+  def resolve_in_checkout(self, shortcut, checkout):
+    """Expand |shortcut| with $CRROOT being the root of the checkout named
+    |checkout| (see Checkouts)."""
+    if self.checkouts is None:
+      self.checkouts = Checkouts()
+    root = self.checkouts.find(checkout)
+    if root is None:
+      raise UnknownShortcut(str.format('Unknown checkout "{0}"', checkout))
+    if shortcut not in self.shortcuts:
+      raise UnknownShortcut(str.format('Unknown shortcut "{0}"', shortcut))
+    return self.expand_shortcut(shortcut, root)
+
+  def matches(self, query):
+    """Return [(score, path, name)] for the shortcuts and history entries
+    matching |query|, best first.
+
+    If |query| is a prefix of any shortcut names only those are returned,
+    ranked by frecency. Otherwise shortcut names and history paths are
+    fuzzy matched and ranked by match quality weighted by frecency."""
+    if self.index is None:
+      self.index = ShortcutIndex(self.shortcuts)
+    now = time.time()
+    prefixed = self.index.prefixed(query)
+    if prefixed:
+      ranked = []
+      for name in prefixed:
+        path = self.expand_shortcut(name)
+        ranked.append((self.history.score(path, now), path, name))
     else:
-      print(str.format('Unknown shortcut "{0}"', shortcut), file=sys.stderr)
+      import math
+      candidates = {}
+      for name in self.shortcuts:
+        match = ShortcutIndex.fuzzy_score(query, name)
+        if match:
+          candidates[self.expand_shortcut(name)] = (match, name)
+      for path in self.history.entries:
+        if path not in candidates:
+          match = ShortcutIndex.fuzzy_score(query, path)
+          if match:
+            candidates[path] = (match, None)
+      ranked = [(match * (1 + math.log1p(self.history.score(path, now))),
+                 path, name)
+                for (path, (match, name)) in candidates.items()]
+    ranked.sort(key=lambda m: (-m[0], m[2] is None, len(m[1])))
+    return ranked
+
+  def resolve(self, shortcut):
+    """Return the expanded value of |shortcut| or raise UnknownShortcut.
+
+    "name@checkout" expands the shortcut in the named checkout. Any other
+    |shortcut| which is not a shortcut name resolves to the best of
+    matches(), unless the best two are tied."""
+    if shortcut in self.shortcuts:
+      return self.expand_shortcut(shortcut)
+    if '@' in shortcut:
+      (name, _, checkout) = shortcut.rpartition('@')
+      return self.resolve_in_checkout(name, checkout)
+    ranked = self.matches(shortcut)
+    if not ranked:
+      raise UnknownShortcut(str.format('Unknown shortcut "{0}"', shortcut))
+    if len(ranked) > 1 and ranked[0][0] == ranked[1][0]:
+      raise UnknownShortcut(str.format(
+          'Ambiguous shortcut "{0}": {1}', shortcut,
+          ', '.join(m[2] or m[1] for m in ranked[:8])))
+    return ranked[0][1]
+
+  def getval(self, shortcut):
+    try:
+      return self.resolve(shortcut)
+    except UnknownShortcut as e:
+      print(e, file=sys.stderr)
       sys.exit(3)
 
+def NewGo(cwd):
+  """Return a Go for |cwd|, exiting if the Chromium root is unknown."""
+  try:
+    return Go(cwd)
+  except NoRootException as e:
+    print(e, file=sys.stderr)
+    sys.exit(2)
+
+class RootCache:
+  """A persistent cache of known Chromium checkout roots.
+
+  Maps each root path to the mtime of that directory when it was last
+  verified with Go.is_chrome_root_dir. A lookup probes the cache for cwd
+  and each of its parents (string operations only) and validates the
+  longest match with a single stat, so the common case does no walk.
+
+  Directories found to be outside any checkout are cached too, with their
+  own mtime. As a checkout could still appear in one of their parents,
+  these misses expire after |miss_ttl| seconds.
+  """
+  default_path = '~/.goroots'
+  miss_ttl = 3600
+  max_misses = 1000
+
+  def __init__(self, path=None):
+    self.path = os.path.expanduser(path or RootCache.default_path)
+    self.roots = {}
+    # path -> (mtime, time cached)
+    self.misses = {}
+    self.dirty = False
+    cached = ReadMarshaled(self.path)
+    if isinstance(cached, tuple) and len(cached) == 2:
+      (self.roots, self.misses) = cached
+
+  @staticmethod
+  def _mtime(path):
+    try:
+      return os.stat(path).st_mtime_ns
+    except OSError:
+      return None
+
+  def lookup(self, some_chrome_dir):
+    """Return the cached root containing |some_chrome_dir| if it is still
+    valid, else None."""
+    path = some_chrome_dir
+    while True:
+      mtime = self.roots.get(path)
+      if mtime is not None:
+        current = RootCache._mtime(path)
+        if current == mtime:
+          return path
+        # Entries were added or removed: verify it again.
+        if current is not None and Go.is_chrome_root_dir(path):
+          self.roots[path] = current
+          self.dirty = True
+          return path
+        del self.roots[path]
+        self.dirty = True
+      parent = os.path.dirname(path)
+      if parent == path or not parent:
+        return None
+      path = parent
+
+  def is_known_miss(self, some_dir):
+    miss = self.misses.get(some_dir)
+    if miss is None:
+      return False
+    if miss[0] == RootCache._mtime(some_dir) and \
+        time.time() - miss[1] < RootCache.miss_ttl:
+      return True
+    del self.misses[some_dir]
+    self.dirty = True
+    return False
+
+  def get_chrome_dir(self, some_chrome_dir):
+    """Like Go.get_chrome_dir, but consulting (and updating) the cache."""
+    if self.is_known_miss(some_chrome_dir):
+      return None
+    root = self.lookup(some_chrome_dir)
+    if root is None:
+      root = Go.get_chrome_dir(some_chrome_dir)
+      if root is not None:
+        mtime = RootCache._mtime(root)
+        if mtime is not None:
+          self.roots[root] = mtime
+          self.dirty = True
+      else:
+        mtime = RootCache._mtime(some_chrome_dir)
+        if mtime is not None:
+          if len(self.misses) >= RootCache.max_misses:
+            oldest = min(self.misses, key=lambda p: self.misses[p][1])
+            del self.misses[oldest]
+          self.misses[some_chrome_dir] = (mtime, time.time())
+          self.dirty = True
+    if self.dirty:
+      self.save()
+    return root
+
+  def save(self):
+    if WriteMarshaled(self.path, (self.roots, self.misses)):
+      self.dirty = False
+
+  @staticmethod
+  def benchmark(some_chrome_dir, iterations=1000):
+    """Print the time per root lookup without and with the cache."""
+    import timeit
+    cache = RootCache()
+    cache.get_chrome_dir(some_chrome_dir)
+    cold = timeit.timeit(lambda: Go.get_chrome_dir(some_chrome_dir),
+                         number=iterations)
+    warm = timeit.timeit(lambda: cache.get_chrome_dir(some_chrome_dir),
+                         number=iterations)
+    print(str.format('root: {0}', cache.get_chrome_dir(some_chrome_dir)))
+    print(str.format('cold: {0:.1f} us/lookup', cold * 1e6 / iterations))
+    print(str.format('warm: {0:.1f} us/lookup', warm * 1e6 / iterations))
+
+class GoServer:
+  """A resident server answering shortcut lookups over a Unix socket.
+
+  This avoids interpreter startup on every lookup. Each request is one
+  line, "<shortcut>\\t<cwd>\\n", and each reply is one line,
+  "<status> <path or message>\\n", where status is the exit status go.py
+  itself would have returned. A lookup needing the client's environment
+  (a value using $VAR) gets no reply, so the client runs it itself. The
+  parsed shortcuts and the root cache stay in memory, and the shortcuts are
+  reloaded when inotify reports a change to ~/.goshortcuts (or, without
+  inotify, when its mtime changes).
+
+  The socket lives in a directory only the user can access, which clients
+  check (see is_trusted_dir) before connecting.
+  """
+
+  @staticmethod
+  def socket_dir():
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp',
+                        'go-%d' % os.getuid())
+
+  @staticmethod
+  def socket_path():
+    return os.path.join(GoServer.socket_dir(), 'socket')
+
+  @staticmethod
+  def is_trusted_dir(path):
+    """Return True if |path| is a real directory owned by, and only
+    accessible to, the current user."""
+    import stat
+    try:
+      st = os.lstat(path)
+    except OSError:
+      return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and \
+        not st.st_mode & 0o077
+
+  def __init__(self, shortcuts_path):
+    self.shortcuts_path = shortcuts_path
+    self.shortcuts = {}
+    self.mtime = None
+    self.root_cache = RootCache()
+    self.history = Frecency()
+    self.checkouts = Checkouts()
+    self.inotify = None
+    self.reload()
+
+  def reload(self):
+    try:
+      self.mtime = os.stat(self.shortcuts_path).st_mtime_ns
+      self.shortcuts = Go.LoadShortcuts(self.shortcuts_path)
+    except (OSError, BadLength, BadValue) as e:
+      print(str.format('Cannot load {0}: {1}', self.shortcuts_path, e),
+            file=sys.stderr)
+
+  def _check_reload(self):
+    if self.inotify:
+      name = os.path.basename(self.shortcuts_path).encode()
+      if any(e[2] == name for e in self.inotify.read_events(0)):
+        self.reload()
+      return
+    try:
+      mtime = os.stat(self.shortcuts_path).st_mtime_ns
+    except OSError:
+      return
+    if mtime != self.mtime:
+      self.reload()
+
+  def answer(self, request):
+    """Return (status, text) for one request line, or None if the client
+    must answer it itself."""
+    (shortcut, _, cwd) = request.partition('\t')
+    try:
+      g = Go(cwd or os.path.expanduser('~'), self.shortcuts, self.root_cache,
+             self.history, self.checkouts, expand_env=False)
+      path = g.resolve(shortcut)
+      self.history.record(path)
+      return (0, path)
+    except NoRootException as e:
+      return (2, str(e))
+    except UnknownShortcut as e:
+      return (3, str(e))
+    except NeedsEnvironment:
+      return None
+
+  def serve(self):
+    import select
+    import signal
+    import socket
+    # Remove the socket when killed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+      from inotify import Inotify
+      if Inotify.Supported():
+        self.inotify = Inotify()
+        # Watch the directory as editors usually replace the file.
+        self.inotify.add_watch(os.path.dirname(self.shortcuts_path),
+                               Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO |
+                               Inotify.IN_CREATE | Inotify.IN_DELETE)
+    except ImportError:
+      pass
+    try:
+      os.mkdir(GoServer.socket_dir(), 0o700)
+    except FileExistsError:
+      pass
+    if not GoServer.is_trusted_dir(GoServer.socket_dir()):
+      print(str.format('{0} must be a directory only you can access',
+                       GoServer.socket_dir()),
+            file=sys.stderr)
+      sys.exit(1)
+    path = GoServer.socket_path()
+    if os.path.exists(path):
+      os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+    try:
+      while True:
+        select.select([listener], [], [])
+        (conn, _) = listener.accept()
+        with conn:
+          conn.settimeout(1.0)
+          request = b''
+          try:
+            while not request.endswith(b'\n'):
+              data = conn.recv(4096)
+              if not data:
+                break
+              request += data
+            self._check_reload()
+            reply = self.answer(request.decode().rstrip('\n'))
+            if reply:
+              # Otherwise closing without a reply makes the client fall back.
+              conn.sendall(str.format('{0} {1}\n', *reply).encode())
+          except (OSError, UnicodeDecodeError):
+            pass
+    finally:
+      listener.close()
+      os.unlink(path)
+
+def AskServer(shortcut, cwd):
+  """Return (status, text) from a running GoServer, or None if there is
+  none (or its socket is not in a directory only this user can access)."""
+  import socket
+  if not GoServer.is_trusted_dir(GoServer.socket_dir()):
+    return None
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      s.connect(GoServer.socket_path())
+      s.sendall(str.format('{0}\t{1}\n', shortcut, cwd).encode())
+      reply = b''
+      while not reply.endswith(b'\n'):
+        data = s.recv(4096)
+        if not data:
+          return None
+        reply += data
+  except OSError:
+    return None
+  (status, _, text) = reply.decode().rstrip('\n').partition(' ')
+  return (int(status), text)
+
 if __name__ == '__main__':
-  import doctest
-  doctest.testmod()
+  if sys.argv[1:] == ['--test']:
+    import doctest
+    doctest.testmod()
+    sys.exit(0)
   cwd = os.path.abspath(os.getcwd())
-  g = Go(cwd)
+  if sys.argv[1:] == ['--benchmark']:
+    RootCache.benchmark(cwd)
+    sys.exit(0)
+  if sys.argv[1:] == ['--serve']:
+    try:
+      GoServer(os.path.expanduser('~/.goshortcuts')).serve()
+    except KeyboardInterrupt:
+      pass
+    sys.exit(0)
+  if sys.argv[1:] == ['--checkouts']:
+    checkouts = Checkouts()
+    checkouts.scan()
+    for (name, root) in sorted(checkouts.by_name().items()):
+      print(str.format('{0:>12} -> {1}', name, root))
+    sys.exit(0)
+  if len(sys.argv) == 3 and sys.argv[1] == '--match':
+    for (score, path, name) in NewGo(cwd).matches(sys.argv[2]):
+      print(str.format('{0:8.2f}  {1:<10} {2}', score, name or '', path))
+    sys.exit(0)
+  # Options are all handled above, so only shortcuts reach the server.
+  if len(sys.argv) == 2 and not sys.argv[1].startswith('-') and \
+      os.path.exists(GoServer.socket_path()):
+    reply = AskServer(sys.argv[1], cwd)
+    if reply:
+      (status, text) = reply
+      print(text, file=sys.stderr if status else sys.stdout)
+      sys.exit(status)
+  g = NewGo(cwd)
   if len(sys.argv) == 2:
-    print(str.format("{0}", g.getval(sys.argv[1])))
+    path = g.getval(sys.argv[1])
+    g.history.record(path)
+    print(str.format("{0}", path))
   else:
     g.do_print()
     sys.exit(1)
@@ -0,0 +1,76 @@
+# inotify.py is a minimal ctypes wrapper around the Linux inotify API,
+# shared by the scripts which wait for file system changes instead of
+# polling.
+
+import ctypes
+import ctypes.util
+import os
+import platform
+import select
+import struct
+
+
+class Inotify(object):
+    """Minimal ctypes wrapper around the Linux inotify API."""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o4000
+
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(Inotify.IN_CLOEXEC |
+                                          Inotify.IN_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    @staticmethod
+    def Supported():
+        return platform.system() == 'Linux'
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self, timeout=None):
+        """Block until events arrive (or |timeout| seconds pass) and return
+        all pending events as a list of (wd, mask, name) tuples."""
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            (wd, mask, _, name_len) = Inotify.event_header.unpack_from(data,
+                                                                        pos)
+            pos += Inotify.event_header.size
+            name = data[pos:pos + name_len].rstrip(b'\0')
+            pos += name_len
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)